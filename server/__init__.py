@@ -1,24 +1,57 @@
-from flask import Flask, render_template, send_from_directory
+from flask import Flask, render_template, send_from_directory, request
+from werkzeug.security import safe_join
 from .page import main_page
 from .api import api
+from . import reference
+import os, mimetypes
 
 app = Flask(__name__)
 app.config.from_object('config')
 app.register_blueprint(main_page)
 app.register_blueprint(api)
 
+#
+# Read the reference data now, so that under gunicorn --preload it is
+# shared by the workers (see server/reference.py)
+#
+if app.config.get('PRELOAD_REFERENCE', True):
+    with app.app_context():
+        reference.preload()
+
 #
 # Static routes, provided here for development.
 # Consider routing these directly from your web server.
 #
+# Precompressed copies (see server/precompress.py) are sent to clients
+# that accept them, unless the original has changed since.
+#
+def send_static(folder, path):
+    for encoding, suffix in (("br",".br"), ("gzip",".gz")):
+        if encoding not in request.accept_encodings:
+            continue
+        source = safe_join(os.path.join(app.root_path, folder), path)
+        target = safe_join(os.path.join(app.root_path, folder), path+suffix)
+        if target is None or not os.path.isfile(target):
+            continue
+        if os.path.isfile(source) and os.path.getmtime(target) < os.path.getmtime(source):
+            continue
+        response = send_from_directory(folder, path+suffix, mimetype=mimetypes.guess_type(path)[0])
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        return response
+
+    response = send_from_directory(folder, path)
+    response.vary.add('Accept-Encoding')
+    return response
+
 @app.route('/css/<path:path>')
 def send_css(path):
-    return send_from_directory('../static/css', path)
+    return send_static('../static/css', path)
 
 @app.route('/js/<path:path>')
 def send_js(path):
-    return send_from_directory('../static/js', path)
+    return send_static('../static/js', path)
     
 @app.route('/assets/<path:path>')
 def send_assets(path):
-    return send_from_directory('../static/assets', path)
\ No newline at end of file
+    return send_static('../static/assets', path)
@@ -1,9 +1,41 @@
 from flask import Blueprint, jsonify, request
 from .drivers import country, state, county
+from . import scheduler
+from .connections import redis_client
+from .responses import cached, lookup, target
 
 api = Blueprint('api', __name__)
+
+#
+# The cache entries each chart is drawn from, for the response cache
+#
+def country_sources(args):
+    return ["country4"]
+
+def state_sources(args):
+    code = args['code']
+    if args['mode'] == 'V':
+        return ["statevac"+code]
+    if args['mode'] == 'H':
+        return ["state"+code, "statehos"+code]
+    return ["state"+code]
+
+def state_composite_sources(args):
+    mode = args['mode']
+    if mode in ('VB','VP'):
+        return ["staterecvac"]
+    if mode in ('B4','B4C','B4F'):
+        return ["state"+code for code in ("TX","CA","NY","FL")]
+    if mode in ('TC','TCC','TF','TFC'):
+        return ["staterecent"] + ["state"+code for code in state.menu()['abbrev']]
+    return ["staterecent"]
+
+def county_sources(args):
+    return ["counties"]
+
     
 @api.route("/api/country/graph")
+@cached({'code':'US', 'time':'0'}, country_sources, 1800)
 def plot_country():
     return jsonify(country.plot(
         request.args.get('code','US'),
@@ -12,6 +44,7 @@ def plot_country():
 
 
 @api.route("/api/country/composite")
+@cached({'mode':'TC', 'time':'0'}, country_sources, 1800)
 def plot_country_composite():
     mode = request.args.get('mode','TC')
     time = int(request.args.get('time',0))
@@ -25,6 +58,7 @@ def plot_country_composite():
 
     
 @api.route("/api/state/graph")
+@cached({'code':'US', 'mode':'D', 'time':'0'}, state_sources, 600)
 def plot_state():
     code = request.args.get('code','US')
     mode = request.args.get('mode','D')
@@ -38,6 +72,7 @@ def plot_state():
 
     
 @api.route("/api/state/composite")
+@cached({'mode':'TC', 'time':'0'}, state_composite_sources, 600)
 def plot_state_composite():
     mode = request.args.get('mode','TC')
     if mode == 'VB':
@@ -66,6 +101,7 @@ def plot_state_composite():
 
 
 @api.route("/api/county/simple")
+@cached({'code':'Santa Clara, California', 'time':'0'}, county_sources, 600)
 def plot_county_simple():
     return jsonify(county.simple_plot(
         request.args.get('code','Santa Clara, California'),
@@ -74,6 +110,7 @@ def plot_county_simple():
 
     
 @api.route("/api/county/composite")
+@cached({'mode':'B', 'time':'0'}, county_sources, 600)
 def plot_county_composite():
     mode = request.args.get('mode','B')
     if mode == "CC":
@@ -93,9 +130,59 @@ def plot_county_composite():
 
 
 @api.route("/api/county/compare")
+@cached({
+    'code1':'Santa Clara, California',
+    'code2':'Harris, California',
+    'time':'0'
+}, county_sources, 600)
 def plot_county_compare():
     return jsonify(county.compare_plot(
         request.args.get('code1','Santa Clara, California'),
         request.args.get('code2','Harris, California'),
         int(request.args.get('time',0))
     ))
+
+
+#
+# Typeahead for the country and county menus (see server/search.py), e.g.
+#     /api/county/search?q=santa&page=1
+#
+@api.route("/api/country/search")
+def country_search():
+    return searched(country.search(
+        request.args.get('q',''),
+        request.args.get('page',1,type=int)
+    ))
+
+
+@api.route("/api/county/search")
+def county_search():
+    return searched(county.search(
+        request.args.get('q',''),
+        request.args.get('page',1,type=int)
+    ))
+
+
+def searched(results):
+    response = jsonify(results)
+    response.cache_control.public = True
+    response.cache_control.max_age = 600
+    return response
+
+
+#
+# Datasets of a chart requested with data=url or data=columns, e.g.
+#     /api/data/state/graph?code=CA&mode=D&time=0&v=3&set=0&format=columns
+#
+@api.route("/api/data/<path:chart>")
+def chart_data(chart):
+    found = target(request.path, request.args)
+    serve = found and lookup(found[0])
+    if serve is None:
+        return jsonify({'status':'failure'}), 404
+    return serve(*found)
+
+
+@api.route("/api/status")
+def status():
+    return jsonify(scheduler.status(redis_client()))
@@ -0,0 +1,128 @@
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+from urllib.parse import parse_qsl
+from a2wsgi import WSGIMiddleware
+from . import app, responses
+from .connections import shared
+import gzip, redis.asyncio
+
+#
+# ASGI entry point, an alternative to serving the flask app with
+# synchronous gunicorn workers. Run with, for example:
+#
+#     uvicorn --workers 3 --uds /run/nginx/flask.sock server.asgi:application
+#
+# Chart requests whose rendered response is already in redis (see
+# server/responses.py), which is most of them, are answered on the event
+# loop, with an async redis client, and never occupy a thread.
+#
+# Everything else (rendering a chart, which may mean downloading its data,
+# and the other routes) is handed to the flask app, running in a pool of
+# ASGI_THREADS threads (default 16) per worker. A slow upstream download
+# then holds one of those threads, rather than a whole worker, and the
+# pandas and Altair work stays off the event loop.
+#
+flask_app = WSGIMiddleware(app, workers=app.config.get('ASGI_THREADS',16))
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "http" and scope["method"] in ("GET","HEAD"):
+        if await from_cache(scope, send):
+            return
+    await flask_app(scope, receive, send)
+
+
+def redis_client():
+    return redis.asyncio.Redis(connection_pool=shared("aioredis", lambda: redis.asyncio.BlockingConnectionPool(
+        host = app.config['REDIS_HOST'],
+        port = app.config['REDIS_PORT'],
+        max_connections = app.config.get('REDIS_POOL_SIZE',16),
+        timeout = app.config.get('REDIS_POOL_TIMEOUT',20)
+    )))
+
+
+#
+# Answer to a dataset of another version than the current one (see
+# server/responses.py)
+#
+STALE = b'{"status":"failure"}\n'
+
+
+#
+# Send the cached response to a chart request, if it is current
+#
+# This follows cached() in server/responses.py, without rendering. Returns
+# False, having sent nothing, if the flask app must answer instead.
+#
+async def from_cache(scope, send):
+    path = scope["path"]
+    if not path.startswith("/api/"):
+        return False
+
+    query = MultiDict(parse_qsl(scope["query_string"].decode("latin-1"), keep_blank_values=True))
+    found = responses.target(path, query)
+    if found is None:
+        return False
+    path, part = found
+
+    headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k,v in scope["headers"]}
+
+    with app.app_context():
+        settings = responses.lookup(path, "settings")
+        if settings is None:
+            return False
+        params, sources, max_age = settings
+
+        args = responses.arguments(params, query)
+        token = responses.response_token(path, args)
+        keys = ["version:" + k for k in sources(args)]
+
+    encoding = responses.negotiate(parse_accept_header(headers.get("accept-encoding")))
+
+    rconn = redis_client()
+    counts = await rconn.mget(keys) if keys else []
+    current = ".".join("0" if c is None else c.decode() for c in counts)
+
+    if responses.dataset(part) and query.get('v') != current:
+        await send({"type": "http.response.start", "status": 404, "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(STALE)).encode())
+        ]})
+        await send({"type": "http.response.body", "body": b"" if scope["method"] == "HEAD" else STALE})
+        return True
+
+    stamp, stored, expires, tag = await rconn.hmget(token, ["version", "encodings", "expires", "tag:"+part])
+    if stamp is None or stamp.decode() != current or stored != responses.ENCODINGS.encode() or tag is None:
+        return False
+    if responses.expired(expires):
+        return False
+
+    etag = responses.entity_tag(tag.decode(), encoding)
+    fields = [
+        (b"etag", quote_etag(etag).encode()),
+        (b"cache-control", "public, max-age={}".format(max_age).encode()),
+        (b"vary", b"Accept-Encoding")
+    ]
+
+    if parse_etags(headers.get("if-none-match")).contains(etag):
+        await send({"type": "http.response.start", "status": 304, "headers": fields})
+        await send({"type": "http.response.body", "body": b""})
+        return True
+
+    body = await rconn.hget(token, responses.field(part,encoding))
+    if body is None:
+        return False
+
+    if encoding:
+        fields.append((b"content-encoding", encoding.encode()))
+    else:
+        body = gzip.decompress(body)
+
+    fields += [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode())
+    ]
+
+    await send({"type": "http.response.start", "status": 200, "headers": fields})
+    await send({"type": "http.response.body", "body": b"" if scope["method"] == "HEAD" else body})
+    return True
@@ -0,0 +1,491 @@
+from flask import current_app as app
+from redis.exceptions import LockError
+from os import path
+from . import upstream
+from .lru import lru
+from .connections import shared, redis_client
+import os, time, threading, pyarrow, pyarrow.feather
+
+#
+# Shared dataframe cache, stored in redis hashes
+#
+# Dataframes are stored in the Arrow IPC file format, which can be read
+# directly out of the buffer returned by redis, and lets us pull only the
+# columns we want before converting to pandas. Compression (lz4 or zstd)
+# is optional, set by CACHE_COMPRESSION in config.py.
+#
+def serialize(frame):
+    table = pyarrow.Table.from_pandas(frame, preserve_index=False)
+    options = pyarrow.ipc.IpcWriteOptions(compression=app.config.get('CACHE_COMPRESSION'))
+
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_file(sink, table.schema, options=options) as writer:
+        writer.write_table(table)
+
+    return sink.getvalue().to_pybytes()
+
+
+def deserialize(blob, columns=None):
+    table = pyarrow.ipc.open_file(pyarrow.py_buffer(blob)).read_all()
+
+    #
+    # Like DataFrame.filter(items=...), quietly skip columns we don't have
+    #
+    if columns is not None:
+        table = table.select([c for c in columns if c in table.column_names])
+
+    return table.to_pandas()
+
+
+#
+# Local columnar files, for data we keep between refreshes, stored
+# in STORE_DIR (by default, DATA_DIR)
+#
+# A file is considered expired max_age seconds after it was last saved
+# with touch=True, so that incremental updates don't reset the clock.
+#
+def load_file(name, max_age=None):
+    filename = file_path(name)
+    if not path.exists(filename):
+        return None
+
+    if max_age is not None:
+        created = filename + ".created"
+        if not path.exists(created) or time.time() - path.getmtime(created) > max_age:
+            return None
+
+    return pyarrow.feather.read_feather(filename)
+
+
+def save_file(name, frame, touch=True):
+    filename = file_path(name)
+
+    #
+    # Write then rename, so readers never see a partial file
+    #
+    pyarrow.feather.write_feather(
+        frame.reset_index(drop=True), filename+".tmp",
+        compression = app.config.get('CACHE_COMPRESSION') or "uncompressed"
+    )
+    os.replace(filename+".tmp", filename)
+
+    if touch:
+        open(filename+".created","w").close()
+
+
+def file_path(name):
+    return path.join(app.config.get('STORE_DIR',app.config['DATA_DIR']),name)
+
+
+#
+# Fetch a cached dataframe, or None if missing or expired. Pass expires=None
+# for entries that never expire.
+#
+def get(rconn, key, field="dataframe", expires="expires", columns=None):
+    answer, fresh = lookup(rconn, key, field, expires, columns)
+    return answer if fresh else None
+
+
+#
+# Returns the cached dataframe (or None) and whether it is current.
+#
+# A partitioned entry (see put_all) may be current but simply not have
+# the field asked for. Entries left behind by the old pyarrow serialization
+# context are not readable as Arrow IPC, and are treated as expired.
+#
+# Current dataframes are also kept in memory (see below), and callers
+# are handed a copy, which they are free to modify. Each copy is tagged
+# with the version of the entry it was read as, and used only while that
+# is still the version in redis, so a worker never reads older data than
+# the version it sees.
+#
+def lookup(rconn, key, field="dataframe", expires="expires", columns=None):
+    local = memory()
+    token = (key, field, expires, None if columns is None else tuple(columns))
+    if local is not None and local.tag(token) is not None:
+        answer = local.get(token, rconn.get("version:" + key))
+        if answer is not None:
+            return answer.copy(), True
+
+    #
+    # Read the entry and its version together (see put)
+    #
+    pipe = rconn.pipeline()
+    pipe.hmget(key, [expires or field, field])
+    pipe.get("version:" + key)
+    (stamp, blob), tag = pipe.execute()
+
+    if expires is None:
+        stamp = float("inf")
+    elif stamp is None or time.time() >= float(stamp):
+        return decode(blob, columns), False
+
+    answer = decode(blob, columns)
+    if answer is None:
+        return None, blob is None and expires is not None
+
+    if local is not None and tag is not None:
+        local.put(token, answer, float(stamp), tag)
+        answer = answer.copy()
+
+    return answer, True
+
+
+def decode(blob, columns=None):
+    if blob is None:
+        return None
+
+    try:
+        return deserialize(blob, columns)
+    except pyarrow.ArrowInvalid:
+        return None
+
+
+#
+# Save a dataframe, along with its expiration time (if ttl is given),
+# and a new version, in one transaction
+#
+def put(rconn, key, frame, field="dataframe", expires="expires", ttl=None):
+    mapping = {field: serialize(frame)}
+    if ttl is not None:
+        mapping[expires] = str(time.time()+ttl)
+
+    pipe = rconn.pipeline()
+    pipe.hset(key, mapping=mapping)
+    pipe.incr("version:" + key)
+    pipe.execute()
+    announce(rconn, key)
+
+
+#
+# Replace a partitioned entry, a dictionary of dataframes, each stored
+# in its own field of the hash, sharing one expiration time. The old
+# entry is removed in the same transaction, so that readers never see
+# a mix of old and new partitions.
+#
+def put_all(rconn, key, frames, expires="expires", ttl=None):
+    mapping = {field: serialize(frame) for field,frame in frames.items()}
+    if ttl is not None:
+        mapping[expires] = str(time.time()+ttl)
+
+    pipe = rconn.pipeline()
+    pipe.delete(key)
+    pipe.hset(key, mapping=mapping)
+    pipe.incr("version:" + key)
+    pipe.execute()
+    announce(rconn, key)
+
+
+#
+# In-memory copies of current dataframes, per worker, so that popular
+# entries don't need a trip to redis. The total size is limited to
+# CACHE_LOCAL_BYTES (set to zero to disable), and entries are kept no
+# longer than their redis expiration, or CACHE_LOCAL_MAX_AGE seconds.
+#
+# Whenever an entry is saved, the redis key is published on the
+# "cache:invalidate" channel, and every worker drops its copies, to free
+# the memory. (Copies are checked against the version in any case.)
+#
+def memory():
+    if not app.config.get('CACHE_LOCAL_BYTES',256*1024*1024):
+        return None
+    return shared("memory", make_memory)
+
+
+def make_memory():
+    local = lru(app.config.get('CACHE_LOCAL_BYTES',256*1024*1024), app.config.get('CACHE_LOCAL_MAX_AGE',60.0))
+
+    #
+    # If we lose our subscription, we may have missed something
+    #
+    def lost(exception, pubsub, thread):
+        local.clear()
+        time.sleep(1.0)
+
+    pubsub = redis_client().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(**{"cache:invalidate": lambda message: local.drop(message['data'].decode())})
+    pubsub.run_in_thread(sleep_time=1.0, daemon=True, exception_handler=lost)
+
+    return local
+
+
+def invalidate(rconn, key):
+    rconn.incr("version:" + key)
+    announce(rconn, key)
+
+
+def announce(rconn, key):
+    rconn.publish("cache:invalidate", key)
+
+
+#
+# A string identifying the current contents of the given redis keys,
+# which changes whenever any of them is saved
+#
+def version(rconn, keys):
+    keys = list(keys)
+    if len(keys) == 0:
+        return ""
+    counts = rconn.mget(["version:" + k for k in keys])
+    return ".".join("0" if c is None else c.decode() for c in counts)
+
+
+#
+# The time at which the first of the given entries expires (infinity if
+# none of them do)
+#
+def expiry(rconn, keys, expires="expires"):
+    pipe = rconn.pipeline(transaction=False)
+    for k in keys:
+        pipe.hget(k, expires)
+    return min((float(stamp) for stamp in pipe.execute() if stamp is not None), default=float("inf"))
+
+
+#
+# Save the result of a build function, which is either a dataframe, or a
+# dictionary of partitions, and return the dataframe for the given field
+#
+def store(rconn, key, built, field="dataframe", expires="expires", ttl=None):
+    if isinstance(built, dict):
+        put_all(rconn, key, built, expires, ttl)
+        return built.get(field)
+
+    put(rconn, key, built, field, expires, ttl)
+    return built
+
+
+#
+# Call build() and save the result.
+#
+# If build() finds that upstream hasn't changed (upstream.NotModified),
+# keep what we have, and just push back its expiration. If we don't have
+# anything, try again, without the conditional request.
+#
+def rebuild(rconn, key, build, field="dataframe", expires="expires", ttl=None):
+    try:
+        built = build()
+    except upstream.NotModified as e:
+        if not rconn.hexists(key, expires):
+            upstream.forget(e.url)
+            built = build()
+        else:
+            rconn.hset(key, expires, str(time.time()+ttl))
+            return decode(rconn.hget(key, field))
+
+    return store(rconn, key, built, field, expires, ttl)
+
+
+#
+# Fetch a cached dataframe, calling build() to replace it once expired.
+#
+# Only one worker rebuilds a given entry at a time, coordinated by a redis
+# lock with a lease (CACHE_LOCK_LEASE seconds), so an expiry under load
+# doesn't send every worker off to download the same data.
+#
+# If a stale copy exists, and CACHE_STALE_WHILE_REVALIDATE is set (the
+# default), the stale copy is returned immediately and the lock holder
+# refreshes it in a background thread. Otherwise we wait (no more than
+# CACHE_LOCK_WAIT seconds) for the lock holder to finish.
+#
+# The build function may return a dictionary of partitions, in which case
+# they are all saved together, and the lock is taken on the whole entry.
+#
+def fetch(rconn, key, build, ttl, field="dataframe", expires="expires", columns=None):
+    answer, fresh = lookup(rconn, key, field, expires, columns)
+    if fresh:
+        return answer
+
+    lock = refresh_lock(rconn, key, expires)
+
+    if answer is not None and app.config.get('CACHE_STALE_WHILE_REVALIDATE',True):
+        if lock.acquire(blocking=False):
+            background(lambda: refresh(rconn, lock, key, build, ttl, field, expires))
+        return answer
+
+    if not lock.acquire(blocking_timeout=app.config.get('CACHE_LOCK_WAIT',120.0)):
+        #
+        # The lock holder is taking too long. Settle for stale data if we have it,
+        # otherwise go get it ourselves.
+        #
+        if answer is not None:
+            return answer
+        frame = rebuild(rconn, key, build, field, expires, ttl)
+    else:
+        frame = refresh(rconn, lock, key, build, ttl, field, expires)
+
+    return frame if frame is None or columns is None else frame.filter(items=columns)
+
+
+#
+# Rebuild an entry before it expires, as the background scheduler does.
+# Returns False, without waiting, if someone else is already refreshing it.
+#
+def renew(rconn, key, build, ttl, field="dataframe", expires="expires"):
+    lock = refresh_lock(rconn, key, expires)
+    if not lock.acquire(blocking=False):
+        return False
+
+    try:
+        rebuild(rconn, key, build, field, expires, ttl)
+    finally:
+        release(lock)
+
+    return True
+
+
+#
+# Rebuild an entry while holding its lock, unless another worker beat us to it
+#
+def refresh(rconn, lock, key, build, ttl, field="dataframe", expires="expires"):
+    try:
+        frame, fresh = lookup(rconn, key, field, expires)
+        if not fresh:
+            frame = rebuild(rconn, key, build, field, expires, ttl)
+        return frame
+    finally:
+        release(lock)
+
+
+#
+# Fetch several cached dataframes, each in its own key, that can be built
+# together. build(keys) is given the keys that need building, and returns
+# a dictionary of dataframes, by key. Returns a dictionary, in the order of
+# the keys given.
+#
+# The same locks are taken as by fetch, one per key, so this can be mixed
+# freely with fetch (or renew) on the individual keys. Keys that another
+# worker is already refreshing are left to it.
+#
+def fetch_many(rconn, keys, build, ttl):
+    answers = {}
+    stale = []
+    for key in keys:
+        answers[key], fresh = lookup(rconn, key)
+        if not fresh:
+            stale.append(key)
+
+    if not stale:
+        return answers
+
+    locks = {}
+    for key in stale:
+        lock = refresh_lock(rconn, key)
+        if lock.acquire(blocking=False):
+            locks[key] = lock
+
+    swr = app.config.get('CACHE_STALE_WHILE_REVALIDATE',True)
+
+    if locks:
+        if swr and all(answers[k] is not None for k in locks):
+            background(lambda: refresh_many(rconn, locks, build, ttl))
+        else:
+            answers.update(refresh_many(rconn, locks, build, ttl))
+
+    for key in stale:
+        if key not in locks and (answers[key] is None or not swr):
+            answers[key] = fetch(rconn, key, lambda key=key: build([key])[key], ttl)
+
+    return answers
+
+
+#
+# Rebuild several entries together before they expire, as the background
+# scheduler does. Entries someone else is already refreshing are skipped.
+#
+def renew_many(rconn, keys, build, ttl):
+    locks = {}
+    for key in keys:
+        lock = refresh_lock(rconn, key)
+        if lock.acquire(blocking=False):
+            locks[key] = lock
+
+    if locks:
+        rebuild_many(rconn, list(locks), build, ttl, locks)
+
+    return list(locks)
+
+
+#
+# As refresh, for several entries, skipping any another worker has
+# rebuilt while we waited
+#
+def refresh_many(rconn, locks, build, ttl):
+    answers = {}
+    todo = []
+    for key in locks:
+        answers[key], fresh = lookup(rconn, key)
+        if fresh:
+            release(locks[key])
+        else:
+            todo.append(key)
+
+    answers.update(rebuild_many(rconn, todo, build, ttl, locks))
+    return answers
+
+
+#
+# As rebuild, for several entries built together, releasing their locks
+#
+def rebuild_many(rconn, keys, build, ttl, locks):
+    try:
+        if not keys:
+            return {}
+
+        try:
+            built = build(keys)
+        except upstream.NotModified as e:
+            if not all(rconn.hexists(k, "expires") for k in keys):
+                upstream.forget(e.url)
+                built = build(keys)
+            else:
+                until = str(time.time()+ttl)
+                for key in keys:
+                    rconn.hset(key, "expires", until)
+                return {k: decode(rconn.hget(k, "dataframe")) for k in keys}
+
+        for key in keys:
+            put(rconn, key, built[key], ttl=ttl)
+        return {k: built[k] for k in keys}
+    finally:
+        for key in keys:
+            release(locks[key])
+
+
+#
+# One lock per expiration stamp, so partitions sharing a stamp share a lock.
+#
+# The lock may be released from a background thread, so its token
+# can't be thread local.
+#
+def refresh_lock(rconn, key, expires="expires"):
+    return rconn.lock(
+        "lock:{}:{}".format(key,expires),
+        timeout = app.config.get('CACHE_LOCK_LEASE',300.0),
+        thread_local = False
+    )
+
+
+def release(lock):
+    try:
+        lock.release()
+    except LockError:
+        #
+        # Our lease expired, and someone else may hold the lock now
+        #
+        pass
+
+
+#
+# Run a function in a daemon thread, inside the current application context
+#
+def background(function):
+    application = app._get_current_object()
+
+    def run():
+        with application.app_context():
+            try:
+                function()
+            except Exception:
+                application.logger.exception("Background refresh failed")
+
+    threading.Thread(target=run, daemon=True).start()
@@ -0,0 +1,104 @@
+from flask import current_app as app
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import os, redis, requests, threading
+
+#
+# Shared connections, one set per worker process
+#
+# Redis clients share a bounded connection pool (REDIS_POOL_SIZE), and
+# upstream requests share a keep-alive session (HTTP_POOL_SIZE connections
+# per host) that retries transient failures (HTTP_RETRIES).
+#
+# Independent fetches can be run at once (see gather), in a pool of
+# FETCH_CONCURRENCY threads, with no more than HTTP_HOST_CONCURRENCY
+# requests to any one upstream host at a time.
+#
+# Pools are keyed by process id, so nothing created before gunicorn
+# forks its workers is shared between them.
+#
+pools = {}
+pools_lock = threading.RLock()
+
+def shared(name, create):
+    key = (os.getpid(), name)
+    with pools_lock:
+        if key not in pools:
+            pools[key] = create()
+        return pools[key]
+
+
+def redis_client():
+    return redis.Redis(connection_pool=shared("redis", lambda: redis.BlockingConnectionPool(
+        host = app.config['REDIS_HOST'],
+        port = app.config['REDIS_PORT'],
+        max_connections = app.config.get('REDIS_POOL_SIZE',16),
+        timeout = app.config.get('REDIS_POOL_TIMEOUT',20)
+    )))
+
+
+def http_session():
+    return shared("http", make_session)
+
+
+def make_session():
+    retry = Retry(
+        total = app.config.get('HTTP_RETRIES',3),
+        backoff_factor = 0.5,
+        status_forcelist = (429,500,502,503,504),
+        allowed_methods = ("GET",)
+    )
+    adapter = HTTPAdapter(
+        pool_connections = 4,
+        pool_maxsize = app.config.get('HTTP_POOL_SIZE',10),
+        max_retries = retry
+    )
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+#
+# Limit on simultaneous requests to the host of the given url
+#
+def host_limit(url):
+    return shared("host:" + urlparse(url).netloc, lambda: threading.BoundedSemaphore(
+        app.config.get('HTTP_HOST_CONCURRENCY',4)
+    ))
+
+
+def executor():
+    return shared("executor", lambda: ThreadPoolExecutor(
+        max_workers = app.config.get('FETCH_CONCURRENCY',8),
+        thread_name_prefix = "fetch"
+    ))
+
+
+#
+# Call each of the given functions (which take no arguments) at once, in
+# the shared executor, inside the current application context, and return
+# their results, in order. Calls made from inside the executor run in turn,
+# so that nested calls can't use up the pool and wait on themselves.
+#
+running = threading.local()
+
+def gather(*functions):
+    if len(functions) < 2 or getattr(running, "inside", False):
+        return [f() for f in functions]
+
+    application = app._get_current_object()
+
+    def run(function):
+        with application.app_context():
+            running.inside = True
+            try:
+                return function()
+            finally:
+                running.inside = False
+
+    futures = [executor().submit(run, f) for f in functions]
+    return [f.result() for f in futures]
@@ -3,12 +3,15 @@ import pandas as pd
 from datetime import date, timedelta
 from os import path
 from io import StringIO
-from flask import current_app as app
-import redis, requests, time, pyarrow, hashlib
+from .. import cache, scheduler, upstream
+from .derived import rolling
+from ..connections import redis_client
+from ..search import index as typeahead_index
+import hashlib
 
 
 def connect():
-    return redis.Redis( host=app.config['REDIS_HOST'], port=app.config['REDIS_PORT'] )
+    return redis_client()
 
 #
 # OurWorldInData has switched to a universal big blob of data
@@ -17,73 +20,98 @@ def connect():
 # This means less fetching, but also much higher memory requirements.
 # Switch cache timeout to 30 minutes.
 #
-def fetchGlobal(rconn):
-    context = pyarrow.default_serialization_context()
-
-    #
-    # Returned cached value, if no more than 30 minutes old
-    #
-    expires = rconn.hget("country3","expires")
-    if expires and time.time() < float(expires):
-        return context.deserialize(rconn.hget("country3","dataframe"))
+# Rather than caching the blob, we split it by country as it comes in.
+# Each country is stored in its own field of the "country4" hash, along
+# with a table of names and populations (field "stats"), so a request
+# only reads the few KB it needs.
+#
+# The 7 day rolling averages, absolute (croll, droll) and per 100,000
+# population (crollpc, drollpc), are calculated here, once per download.
+#
+def fetchGlobal(rconn, field):
+    return cache.fetch(rconn, "country4", downloadGlobal, ttl=1800.0, field=field)
 
+def downloadGlobal():
     #
     # Fetch
-    # Make sure we include a user agent
     #
-    req = requests.get(
-        "https://covid.ourworldindata.org/data/owid-covid-data.csv",
-        headers = {'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:77.0) Gecko/20100101 Firefox/77.0'}
-    )
+    text = upstream.get("https://covid.ourworldindata.org/data/owid-covid-data.csv")
 
-    if req.status_code != 200:
-        raise Exception("Request failure: {}".format(req.status_code))
-
-    answer = pd.read_csv(StringIO(req.text), parse_dates=["date"]).filter(
-        items=("iso_code","location","population","date","new_cases","new_deaths")
+    blob = pd.read_csv(
+        StringIO(text),
+        usecols = ("iso_code","location","population","date","new_cases","new_deaths"),
+        parse_dates = ["date"]
     )
 
     #
-    # Cache
+    # Derived quantities
     #
-    rconn.hset("country3","dataframe",context.serialize(answer).to_buffer().to_pybytes())
-    rconn.hset("country3","expires",str(time.time()+1800.0))
-    return answer
+    blob = blob.sort_values(["iso_code","date"])
+    keys = [blob.iso_code]
+    blob['croll'] = rolling(blob.new_cases, keys)
+    blob['droll'] = rolling(blob.new_deaths, keys)
+    blob['crollpc'] = blob.croll*100000/blob.population
+    blob['drollpc'] = blob.droll*100000/blob.population
 
-def fetchStats(rconn):
-    blob = fetchGlobal(rconn)
-    answer = blob.filter(items=("iso_code","location","population")).drop_duplicates(subset="iso_code")
-    return answer.rename(columns={
+    #
+    # Partition
+    #
+    answer = {
+        code: dt.filter(items=(
+            "date","new_cases","new_deaths","croll","droll","crollpc","drollpc"
+        )).rename(columns={
+            "new_cases": "cases",
+            "new_deaths": "deaths"
+        })
+        for code, dt in blob.groupby("iso_code")
+    }
+
+    answer['stats'] = blob.filter(items=("iso_code","location","population")).drop_duplicates(
+        subset="iso_code"
+    ).rename(columns={
         'iso_code': 'code',
         'location': 'name'
     })
 
+    return answer
 
-def fetchCountry(rconn,code="USA"):
-    blob = fetchGlobal(rconn)
+@scheduler.source("country4", 1500.0)
+def refreshGlobal(rconn):
+    cache.renew(rconn, "country4", downloadGlobal, ttl=1800.0)
 
-    answer = blob[blob.iso_code==code].filter(items=("date","new_cases","new_deaths"))
-    answer = answer.rename(columns={"new_cases": "cases", "new_deaths": "deaths"})
+def fetchStats(rconn):
+    return fetchGlobal(rconn, "stats")
 
-    return answer.sort_values(by="date")
+
+def fetchCountry(rconn,code="USA"):
+    answer = fetchGlobal(rconn, code)
+    if answer is None:
+        return pd.DataFrame(columns=("date","cases","deaths","croll","droll","crollpc","drollpc"))
+    return answer
 
 def menu():
-    blob = fetchGlobal(connect())
-    answer = blob.filter(items=("iso_code","location")).drop_duplicates(subset="iso_code")
+    stats = fetchStats(connect())
 
     return {
-        'abbrev': dict(zip(answer.iso_code,answer.location)),
+        'abbrev': dict(zip(stats.code,stats.name)),
         'default': "USA"
     }
 
 
+def search(query, page=1):
+    def build():
+        stats = fetchStats(r)
+        return stats.code, stats.name
+
+    r = connect()
+    return typeahead_index(r, "country4", build).find(query, page)
+
+
 def plot(code, time):
     r = connect()
     ckey = fetchStats(r)
     dt = fetchCountry(r,code)
 
-    dt['croll'] = dt.cases.rolling(window=7).mean()
-    dt['droll'] = dt.deaths.rolling(window=7).mean()
     if time <= 0:
         dt = dt[dt.date >= pd.to_datetime(date(2020,3,1))]
     else:
@@ -138,11 +166,8 @@ def countries(codes, time):
 
     def make_one(code):
         dt = fetchCountry(r,code)
-        ckey0 = ckey[ckey.code == code]
-        dt['croll'] = dt.cases.rolling(window=7).mean()*100000/ckey0.population.mean()
-        dt['droll'] = dt.deaths.rolling(window=7).mean()*100000/ckey0.population.mean()
         dt = dt[dt.date >= pd.to_datetime(date(2020,3,1))]
-        dt['Country'] = ckey0.name.iat[0]
+        dt['Country'] = ckey[ckey.code == code].name.iat[0]
         return dt
 
     dt = pd.concat([make_one(c) for c in codes])
@@ -154,7 +179,7 @@ def countries(codes, time):
     
     top = chart.mark_line().encode(
         x = alt.X('date:T', title="Date"),
-        y = alt.Y('croll:Q', title="Cases per 100,000"),
+        y = alt.Y('crollpc:Q', title="Cases per 100,000"),
         color = alt.Color("Country:N")
     ).properties(
         width=500, 
@@ -163,7 +188,7 @@ def countries(codes, time):
 
     bot = chart.mark_line().encode(
         x = alt.X('date:T', title="Date"),
-        y = alt.Y('droll:Q', title="Fatalities per 100,000"),
+        y = alt.Y('drollpc:Q', title="Fatalities per 100,000"),
         color = alt.Color("Country:N")
     ).properties(
         width=500, 
@@ -2,127 +2,167 @@ import altair as alt
 import pandas as pd
 import numpy as np
 from datetime import date
-from os import path
+from io import StringIO
 from flask import current_app as app
-import redis, requests, time, pyarrow
+from .. import cache, reference, scheduler, upstream
+from .derived import rolling
+from ..connections import redis_client
+from ..search import index as typeahead_index
 
 def connect():
-    return redis.Redis( host=app.config['REDIS_HOST'], port=app.config['REDIS_PORT'] )
+    return redis_client()
 
-def fetchData(rconn):
-    context = pyarrow.default_serialization_context()
+#
+# The NYT data is split by county as it is downloaded, and each county
+# is stored in its own field ("state:county") of the "counties" hash, along
+# with the list of county names ("names", with the "County, State" labels
+# of the menu, in order) and the most recent 7 day case counts ("latest").
+# All share the same expiration.
+#
+# The 7 day rolling averages of daily cases and fatalities, absolute
+# (proll, froll) and per 100,000 population (crollpc, drollpc), are
+# calculated here, for all counties at once.
+#
+def fetchData(rconn,field):
+    return cache.fetch(rconn, "counties", downloadData, ttl=600.0, field=field)
 
-    #
-    # Check date of main dataframe
-    #
-    expires = rconn.hget("county","expires")
-    if expires and time.time() < float(expires):
-        return context.deserialize(rconn.hget("county","dataframe"))
+def downloadData():
+    dt = updateHistory().sort_values(by=["state","county","dt"]).reset_index(drop=True)
+    keys = [dt.state,dt.county]
 
-    #
-    # Fetch new copy
-    #
-    dt = pd.read_csv("https://github.com/nytimes/covid-19-data/blob/master/us-counties.csv?raw=true")
-    dt['dt'] = pd.to_datetime(dt.date,format="%Y-%m-%d")
+    population = populations(connect(), dt.state, dt.county, dt.get("fips"))
+    dt['proll'] = rolling(dt.dcases, keys)
+    dt['froll'] = rolling(dt.ddeaths, keys)
+    dt['crollpc'] = dt.proll*100000/population
+    dt['drollpc'] = dt.froll*100000/population
 
     #
-    # Save
+    # Partition
     #
-    rconn.hset("county","dataframe",context.serialize(dt).to_buffer().to_pybytes())
-    rconn.hset("county","expires",str(time.time()+600.0))
-    return dt
+    answer = {
+        "{}:{}".format(state,county): part
+        for (state,county), part in dt.groupby(keys)
+    }
 
-def fetchNames(rconn):
-    context = pyarrow.default_serialization_context()
+    names = dt.filter(items=("state","county")).drop_duplicates()
+    names['name'] = names.county + ", " + names.state
+    answer['names'] = names.sort_values("name").reset_index(drop=True)
 
-    if rconn.hexists("county","names"):
-        return context.deserialize(rconn.hget("county","names"))
+    latest = dt.groupby(keys).tail(7).groupby(keys).dcases.sum().clip(lower=0)
+    answer['latest'] = latest.rename("case7").reset_index()
 
-    dt = fetchData(rconn)
-    counties = dt.filter(items=("state","county")).drop_duplicates()
+    return answer
 
-    rconn.hset("county","names",context.serialize(counties).to_buffer().to_pybytes())
-    return counties
+#
+# The full NYT history is millions of rows, but only the last few days
+# change. We keep the processed history in a local file, and only fetch
+# the recent file (the last 30 days), replacing the overlapping dates.
+#
+# The full history is fetched again if the local copy is missing, doesn't
+# reach the start of the recent file, or is older than COUNTY_HISTORY_AGE
+# seconds (default one day), to pick up any corrections to older data.
+#
+def updateHistory():
+    history = cache.load_file("us-counties.arrow", app.config.get('COUNTY_HISTORY_AGE',86400.0))
+
+    if history is not None:
+        recent = downloadNYT("us-counties-recent.csv")
+        cut = recent.dt.min()
+
+        if history.dt.max() >= cut - pd.Timedelta(1,unit="d"):
+            #
+            # Seed the calculation with the last known day of each county
+            #
+            old = history[history.dt < cut]
+            seed = old.groupby([old.state,old.county]).tail(1)
+            dt = pd.concat((old, processCounties(recent, seed)))
+            cache.save_file("us-counties.arrow", dt, touch=False)
+            return dt
+
+    dt = processCounties(downloadNYT("us-counties.csv"))
+    cache.save_file("us-counties.arrow", dt)
+    return dt
 
-def fetchCounty(rconn,state,county):
-    context = pyarrow.default_serialization_context()
+def downloadNYT(name):
+    text = upstream.get("https://github.com/nytimes/covid-19-data/blob/master/{}?raw=true".format(name))
+    dt = pd.read_csv(StringIO(text))
+    dt['dt'] = pd.to_datetime(dt.date,format="%Y-%m-%d")
+    return dt
 
-    #
-    # Check date of main dataframe
-    #
-    key = state + ":" + county 
-    key_expires = key + ":expires"
+#
+# Calculate daily changes and days since first (and tenth) case, for
+# all counties at once. If given, seed holds the last processed row of
+# each county, just before the dates in dt.
+#
+def processCounties(dt, seed=None):
+    if seed is None:
+        dt = dt.assign(seed=False)
+    else:
+        dt = pd.concat((seed.assign(seed=True), dt.assign(seed=False)))
 
-    expires = rconn.hget("county", key_expires)
-    if expires and time.time() < float(expires):
-        return context.deserialize(rconn.hget("county",key))
+    dt = dt.sort_values(by=["state","county","dt"])
+    keys = [dt.state,dt.county]
 
-    #
-    # Fetch new master data frame
-    #
-    dt = fetchData(rconn)
+    for column, threshold in (("days",0), ("days10",9)):
+        start = dt.dt.where(dt.cases>threshold)
+        if seed is not None:
+            #
+            # The seed rows already know when their county started
+            #
+            start = start.where(~dt.seed, dt.dt - pd.to_timedelta(dt[column],unit="D"))
+        dt[column] = (dt.dt - start.groupby(keys).transform("min")).dt.days
 
-    #
-    # Process and save
-    #
-    answer = dt[(dt.state==state) & (dt.county==county)].copy()
-    answer['days'] = (answer.dt-min(answer.dt[answer.cases>0])).dt.days
-    answer['days10'] = (answer.dt-min(answer.dt[answer.cases>9])).dt.days
-    answer = answer.sort_values(by="days")
-    answer['ddeaths'] = answer.deaths.diff()
-    answer['dcases'] = answer.cases.diff()
-
-    states = pd.read_csv(path.join(app.config['DATA_DIR'],"state-abbre.csv"))
-    abbrev = states[states['State']==state]['Code']
-    answer['stcode'] = abbrev.iloc[0] if len(abbrev) > 0 else "?"
-
-    rconn.hset("county",key,context.serialize(answer).to_buffer().to_pybytes())
-    rconn.hset("county",key_expires,str(time.time()+600.0))
-    return answer
+    dt['ddeaths'] = dt.groupby(keys).deaths.diff()
+    dt['dcases'] = dt.groupby(keys).cases.diff()
 
-def fetchPopulationAll(rconn):
-    context = pyarrow.default_serialization_context()
+    dt['stcode'] = dt.state.map(reference.state_codes()).fillna("?")
 
-    #
-    # See if we have this cached
-    #
-    key = 'population'
-    serialized = rconn.hget("county",key)
-    if serialized:
-        return context.deserialize(serialized)
+    return dt[~dt.seed].drop(columns="seed")
 
-    #
-    # Process and save
-    #
-    answer = pd.read_csv(path.join(app.config['DATA_DIR'],"co-est2019-alldata.csv"), encoding='Windows-1252')
-    answer = answer.filter(items=['CTYNAME','STNAME','POPESTIMATE2019'])
-    rconn.hset("county",key,context.serialize(answer).to_buffer().to_pybytes())
-    
-    return answer
+@scheduler.source("counties", 480.0)
+def refreshData(rconn):
+    cache.renew(rconn, "counties", downloadData, ttl=600.0)
 
-def fetchPopulation(rconn,state,county):
-    all = fetchPopulationAll(rconn)
+def fetchNames(rconn):
+    return fetchData(rconn, "names")
 
-    answer = all[(all['CTYNAME'] == county+" County") & (all['STNAME'] == state)]
-    if len(answer) == 1:
-        return answer['POPESTIMATE2019'].values[0]
+def fetchCounty(rconn,state,county):
+    return fetchData(rconn, state + ":" + county)
 
-    #
-    # Remove incompatible suffixes
-    #
-    if county.endswith(" City"):
-        answer = all[(all['CTYNAME'] == county[:-5]+" County") & (all['STNAME'] == state)]
-        if len(answer) == 1:
-            return answer['POPESTIMATE2019'].values[0]
+def fetchPopulationAll(rconn):
+    return reference.county_populations()
 
-    print(f"County population not found: '{county}' '{state}'")
-    return None
+#
+# Population of a county, or None if unknown (see reference.county_population)
+#
+def fetchPopulation(rconn,state,county,fips=None):
+    return reference.county_population(state, county, fips)
 
-def california_county_populations(rconn):
-    context = pyarrow.default_serialization_context()
+#
+# The populations of many counties at once, by the same rules as
+# fetchPopulation (NaN if not found), each looked up once
+#
+def populations(rconn, states, counties, fips=None):
+    if fips is None:
+        fips = np.full(len(states), np.nan)
+
+    rows = pd.Series(list(zip(states,counties,fips)))
+    found = {
+        row: reference.county_population(*row) for row in rows.drop_duplicates()
+    }
+    return rows.map(found).to_numpy(dtype=float)
 
-    if rconn.hexists("county","capop"):
-        return context.deserialize(rconn.hget("county","capop"))
+#
+# Populations of all the counties of a state, by lowercase county name,
+# with and without the census suffix (e.g. "harris" and "harris county")
+#
+def statePopulations(rconn,state):
+    return reference.county_by_state().get(state, {})
+
+def california_county_populations(rconn):
+    ca_pop = cache.get(rconn, "county", "capop", expires=None)
+    if ca_pop is not None:
+        return ca_pop
 
     # from https://www.california-demographics.com/counties_by_population
     raw = """
@@ -190,21 +230,25 @@ def california_county_populations(rconn):
     raw = raw.replace(" County","").replace(",","")
     ca_pop = pd.read_csv(io.StringIO(raw),sep="\t",header=None,names=("rank","county","pop"))
 
-    rconn.hset("county","capop",context.serialize(ca_pop).to_buffer().to_pybytes())
+    cache.put(rconn, "county", ca_pop, "capop")
     return ca_pop
 
 
 def menu():
-    r = connect()
-    counties = fetchNames(r)
-    names = counties.apply(lambda r: '{}, {}'.format(r.county,r.state), axis=1)
-
     return {
-        'names': names.sort_values(),
         'default': "Santa Clara, California",
         'default2': "Harris, Texas"
     }
 
+
+def search(query, page=1):
+    def build():
+        names = fetchNames(r).name
+        return names, names
+
+    r = connect()
+    return typeahead_index(r, "counties", build).find(query, page)
+
 #
 # We'll allow the axis to float a little negative, but
 # not too far, otherwise it can get ugly. Fall down to the next unit 
@@ -232,9 +276,6 @@ def simple_plot(code, time):
     parts = code.split(", ")
     fc = fetchCounty( r, parts[1], parts[0] )
 
-    fc['proll'] = fc.dcases.rolling(window=7).mean()
-    fc['froll'] = fc.ddeaths.rolling(window=7).mean()
-
     fc = fc[fc.dt >= pd.to_datetime(date(2020,3,1))].filter(
         items=("dt","dcases","ddeaths","proll","froll")
     )
@@ -302,9 +343,8 @@ def both(time):
         dt_start = pd.to_datetime(date(2020,3,1))
 
     def fetchHere( r, state, county ):
-        answer = fetchCounty( r, state, county )
+        answer = fetchCounty( r, state, county ).rename(columns={"proll":"droll"})
         answer['name'] = answer['county'] + ", " + answer['stcode']
-        answer['droll'] = answer.dcases.rolling(window=7).mean()
         return answer[answer.dt >= dt_start].filter(items=("dt","dcases","droll","name"))
 
     sa = fetchHere( r, "Oregon", "Marion" )
@@ -367,9 +407,8 @@ def silicon_valley(time):
         dt_start = pd.to_datetime(date(2020,3,1))
 
     def fetchHere( r, state, county ):
-        answer = fetchCounty( r, state, county )
+        answer = fetchCounty( r, state, county ).rename(columns={"proll":"droll"})
         answer['name'] = answer['county'] + ", " + answer['stcode']
-        answer['droll'] = answer.dcases.rolling(window=7).mean()
         return answer[answer.dt >= dt_start].filter(items=("dt","dcases","droll","name"))
 
     dt = pd.concat((
@@ -416,10 +455,11 @@ def compare_plot(code1, code2, time):
         parts = code.split(", ")
         pop = fetchPopulation(r, parts[1], parts[0])
         if pop is None: return None
-        answer = fetchCounty(r, parts[1], parts[0])
+        answer = fetchCounty(r, parts[1], parts[0]).rename(columns={
+            "crollpc": "croll",
+            "drollpc": "droll"
+        })
         answer['name'] = answer['county'] + ", " + answer['stcode']
-        answer['croll'] = answer.dcases.rolling(window=7).mean()*100000/pop
-        answer['droll'] = answer.ddeaths.rolling(window=7).mean()*100000/pop
         return answer[answer.dt >= dt_start].filter(items=("dt","croll","droll","name"))
 
     dt = pd.concat((
@@ -458,11 +498,8 @@ def compare_plot(code1, code2, time):
 
 def california_bar(percapital=False):
     r = connect()
-    dt = fetchData(r)
-    dtca = dt[dt.state=="California"].groupby("county").apply(
-        lambda a: max(a.sort_values(by="dt").cases.diff()[-7:].sum(),0)
-    ).reset_index()
-    dtca = dtca.rename(columns={0:"case7"})
+    dt = fetchData(r, "latest")
+    dtca = dt[dt.state=="California"].filter(items=("county","case7"))
 
     if percapital:
         pop = california_county_populations(r)
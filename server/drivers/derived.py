@@ -0,0 +1,27 @@
+import pandas as pd
+import numpy as np
+
+#
+# Trailing means over the last window rows, for every group at once
+#
+# The same as groupby(keys).rolling(window).mean(), NaN where a window is
+# incomplete or includes a missing value, but done with cumulative sums,
+# so there is no per-group iteration. Rows must already be in order within
+# each group. The answer is aligned with values by position.
+#
+def rolling(values, keys=None, window=7):
+    values = pd.Series(values.to_numpy(dtype=float))
+    valid = values.notna().astype(float)
+
+    if keys is None:
+        by = [np.zeros(len(values), dtype=int)]
+    else:
+        by = [np.asarray(k) for k in keys]
+
+    sums = values.fillna(0).groupby(by).cumsum()
+    count = valid.groupby(by).cumsum()
+
+    total = sums - sums.groupby(by).shift(window).fillna(0)
+    count = count - count.groupby(by).shift(window).fillna(0)
+
+    return np.where(count == window, total/window, np.nan)
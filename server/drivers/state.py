@@ -2,13 +2,14 @@ import altair as alt
 import pandas as pd
 import numpy as np
 from datetime import date, timedelta
-from os import path
 from io import StringIO
 from flask import current_app as app
-import redis, requests, time, pyarrow
+from .. import cache, reference, scheduler, upstream
+from .derived import rolling
+from ..connections import redis_client, gather
 
 def connect():
-    return redis.Redis( host=app.config['REDIS_HOST'], port=app.config['REDIS_PORT'] )
+    return redis_client()
 
 #
 # A simple label placement algorithm, to avoid overlaps
@@ -78,124 +79,145 @@ class label_placement:
 
 
 def fetchState(rconn,key):
-    context = pyarrow.default_serialization_context()
+    return cache.fetch(rconn, "state"+key, lambda: downloadStates([key])[key], ttl=600.0)
+
+
+#
+# Fetch several states, as a dictionary of dataframes by state
+#
+# States that need downloading are fetched together, STATE_BATCH (default
+# 20) at a time, in one query each, rather than one query per state, and
+# the batches are fetched at once (see connections.gather). Each state is
+# still cached in its own entry, shared with fetchState.
+#
+def fetchStates(rconn,keys):
+    answer = {}
+    for found in gather(*[
+        lambda batch=batch: cache.fetch_many(rconn, ["state"+k for k in batch], buildStates, ttl=600.0)
+        for batch in batches(keys)
+    ]):
+        answer.update({k[5:]: v for k,v in found.items()})
+    return answer
 
-    #
-    # Check date of main dataframe
-    #
-    expires = rconn.hget("state"+key,"expires")
-    if expires and time.time() < float(expires):
-        return context.deserialize(rconn.hget("state"+key,"dataframe"))
 
+def buildStates(names):
+    return {"state"+k: v for k,v in downloadStates([n[5:] for n in names]).items()}
+
+
+def batches(keys):
+    size = app.config.get('STATE_BATCH',20)
+    keys = list(keys)
+    return [keys[i:i+size] for i in range(0,len(keys),size)]
+
+
+def downloadStates(keys):
     #
     # Fetch
-    # Make sure we include a user agent. We are limited to 50,000 records per query,
-    # but that should be plenty for this table (which has rows per day)
+    # We are limited to 50,000 records per query,
+    # but that should be plenty for a batch of states (with rows per day)
     #
-    req = requests.get(
+    text = upstream.get(
         "https://data.cdc.gov/resource/9mfq-cb36.csv",
         params={
-            'state': key,
-            '$limit': 5000, 
+            '$where': "state in ({})".format(",".join("'{}'".format(k.replace("'","''")) for k in keys)),
+            '$limit': 50000, 
             '$select': "submission_date,state,new_case,new_death",
             "$$app_token": app.config['SOCRATA_TOKEN']
-        },
-        headers = {'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:77.0) Gecko/20100101 Firefox/77.0'}
+        }
     )
 
-    if req.status_code != 200:
-        raise Exception("Request failure: {}".format(req.status_code))
-
-    answer = pd.read_csv(StringIO(req.text), parse_dates=["submission_date"]).rename(columns={
+    answer = pd.read_csv(StringIO(text), parse_dates=["submission_date"]).rename(columns={
         'submission_date': 'dt'
     })
 
-    answer = answer.sort_values('dt')
+    answer = derive(answer.sort_values('dt'))
 
-    #
-    # Save
-    #
-    rconn.hset("state"+key,"dataframe",context.serialize(answer).to_buffer().to_pybytes())
-    rconn.hset("state"+key,"expires",str(time.time()+600.0))
+    return {k: answer[answer.state == k] for k in keys}
 
-    return answer
+
+#
+# The 7 day rolling averages of new cases and fatalities, absolute (croll,
+# droll) and per 100,000 population (crollpc, drollpc), calculated once per
+# download, for any number of states (sorted by date)
+#
+def derive(dt):
+    pop = fetchPopulation(connect())
+    population = dt.state.map(dict(zip(pop.state,pop.POPESTIMATE2019)))
+
+    keys = [dt.state]
+    dt['croll'] = rolling(dt.new_case, keys)
+    dt['droll'] = rolling(dt.new_death, keys)
+    dt['crollpc'] = 100000*dt.croll/population
+    dt['drollpc'] = 100000*dt.droll/population
+    return dt
+
+
+@scheduler.source("state", 480.0)
+def refreshStates(rconn):
+    gather(*[
+        lambda batch=batch: cache.renew_many(rconn, ["state"+k for k in batch], buildStates, ttl=600.0)
+        for batch in batches(fetchPopulation(rconn).state)
+    ])
 
 
 def fetchRecent(rconn):
-    context = pyarrow.default_serialization_context()
+    return cache.fetch(rconn, "staterecent", downloadRecent, ttl=600.0)
 
-    #
-    # Check date of main dataframe
-    #
-    expires = rconn.hget("staterecent","expires")
-    if expires and time.time() < float(expires):
-        return context.deserialize(rconn.hget("staterecent","dataframe"))
 
+def downloadRecent():
     #
     # Fetch
-    # Make sure we include a user agent. We are limited to 50,000 records per query,
+    # We are limited to 50,000 records per query,
     # but that should be plenty for this table (which has rows per day)
     #
     # Fetch starting from 10 days ago, to ensure we get at least seven
     #
     start = date.today() - timedelta(days=11)
 
-    req = requests.get(
+    text = upstream.get(
         "https://data.cdc.gov/resource/9mfq-cb36.csv",
         params={
             '$where': "submission_date > '{:4d}-{:02d}-{:02d}'".format(start.year,start.month,start.day),
             '$limit': 5000, 
             '$select': "submission_date,state,new_case,new_death",
             "$$app_token": app.config['SOCRATA_TOKEN']
-        },
-        headers = {'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:77.0) Gecko/20100101 Firefox/77.0'}
+        }
     )
 
-    if req.status_code != 200:
-        raise Exception("Request failure: {}".format(req.status_code))
-
-    answer = pd.read_csv(StringIO(req.text), parse_dates=["submission_date"]).rename(columns={
+    answer = pd.read_csv(StringIO(text), parse_dates=["submission_date"]).rename(columns={
         'submission_date': 'dt'
     })
 
     #
     # We actually get some odd "states". Let's remove them.
     #
-    namefile = path.join(app.config['DATA_DIR'],"state-abbre.csv")
-    valid = pd.read_csv(namefile)
-    answer = answer[answer.state.isin(valid.Code)]
+    answer = answer[answer.state.isin(reference.states().Code)]
 
     #
     # Sort
     #
     answer = answer.sort_values('dt')
 
-    #
-    # Save
-    #
-    rconn.hset("staterecent","dataframe",context.serialize(answer).to_buffer().to_pybytes())
-    rconn.hset("staterecent","expires",str(time.time()+600.0))
-
     return answer
 
 
+@scheduler.source("staterecent", 480.0)
+def refreshRecent(rconn):
+    cache.renew(rconn, "staterecent", downloadRecent, ttl=600.0)
+
+
 def fetchHospital(rconn,key):
-    context = pyarrow.default_serialization_context()
+    return cache.fetch(rconn, "statehos"+key, lambda: downloadHospital(key), ttl=600.0)
 
-    #
-    # See: https://dev.socrata.com/foundry/healthdata.gov/g62h-syeh
-    #
 
+def downloadHospital(key):
     #
-    # Check date of main dataframe
+    # See: https://dev.socrata.com/foundry/healthdata.gov/g62h-syeh
     #
-    expires = rconn.hget("statehos"+key,"expires")
-    if expires and time.time() < float(expires):
-        return context.deserialize(rconn.hget("statehos"+key,"dataframe"))
 
     #
     # Fetch
-    # Make sure we include a user agent. We are limited to 50,000 records per query,
+    # We are limited to 50,000 records per query,
     # but that should be plenty for this table (which has rows per day)
     #
     # The HHS sure loves long column names...
@@ -210,52 +232,45 @@ def fetchHospital(rconn,key):
         'total_staffed_adult_icu_beds',
     ]
 
-    req = requests.get(
+    text = upstream.get(
         "https://healthdata.gov/resource/g62h-syeh.csv",
         params={
             'state': key,
             '$limit': 5000, 
             '$select': ",".join(columns),
             "$$app_token": app.config['SOCRATA_TOKEN']
-        },
-        headers = {'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:77.0) Gecko/20100101 Firefox/77.0'}
+        }
     )
 
-    if req.status_code != 200:
-        raise Exception("Request failure: {}".format(req.status_code))
-
-    answer = pd.read_csv(StringIO(req.text), parse_dates=["date"]).rename(columns={
+    answer = pd.read_csv(StringIO(text), parse_dates=["date"]).rename(columns={
         'date': 'dt'
     })
 
     answer = answer.sort_values('dt')
 
-    #
-    # Save
-    #
-    rconn.hset("statehos"+key,"dataframe",context.serialize(answer).to_buffer().to_pybytes())
-    rconn.hset("statehos"+key,"expires",str(time.time()+600.0))
-
     return answer
 
 
+@scheduler.source("statehos", 480.0)
+def refreshHospitals(rconn):
+    gather(*[
+        lambda key=key: cache.renew(rconn, "statehos"+key, lambda: downloadHospital(key), ttl=600.0)
+        for key in fetchPopulation(rconn).state
+    ])
+
+
 def fetchVaccine(rconn,key):
-    context = pyarrow.default_serialization_context()
+    return cache.fetch(rconn, "statevac"+key, lambda: downloadVaccine(key), ttl=600.0)
 
-    #
-    # See: https://dev.socrata.com/foundry/data.cdc.gov/unsk-b7fc
-    #
 
+def downloadVaccine(key):
     #
-    # Check date of main dataframe
+    # See: https://dev.socrata.com/foundry/data.cdc.gov/unsk-b7fc
     #
-    expires = rconn.hget("statevac"+key,"expires")
-    if expires and time.time() < float(expires):
-        return context.deserialize(rconn.hget("statevac"+key,"dataframe"))
 
     #
     # Fetch
-    # Make sure we include a user agent. We are limited to 50,000 records per query,
+    # We are limited to 50,000 records per query,
     # but that should be plenty for this table (which has rows per day)
     #
     columns = [
@@ -264,21 +279,17 @@ def fetchVaccine(rconn,key):
         'series_complete_yes'
     ]
 
-    req = requests.get(
-        " https://data.cdc.gov/resource/unsk-b7fc.csv",
+    text = upstream.get(
+        "https://data.cdc.gov/resource/unsk-b7fc.csv",
         params={
             'Location': key,
             '$limit': 5000, 
             '$select': ",".join(columns),
             "$$app_token": app.config['SOCRATA_TOKEN']
-        },
-        headers = {'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:77.0) Gecko/20100101 Firefox/77.0'}
+        }
     )
 
-    if req.status_code != 200:
-        raise Exception("Request failure: {}".format(req.status_code))
-
-    answer = pd.read_csv(StringIO(req.text), parse_dates=["Date"]).rename(columns={
+    answer = pd.read_csv(StringIO(text), parse_dates=["Date"]).rename(columns={
         'Date': 'date',
         'administered_dose1_recip': 'onedose',
         'series_complete_yes': 'complete'
@@ -287,56 +298,49 @@ def fetchVaccine(rconn,key):
     #
     # Get corresponding FIPS code
     #
-    fipfile = path.join(app.config['DATA_DIR'],"fips-code.csv")
-    fips = pd.read_csv(fipfile,sep="\t")
-    fip_code = fips[fips['key']==key].code.values[0]
+    fip_code = reference.fips_codes()[key]
 
     #
-    # Use this to fetch population by age
+    # Eligible population, by the minimum age on each date
     #
-    popfile = path.join(app.config['DATA_DIR'],"sc-est2019-agesex-civ.csv")
-    pop = pd.read_csv(popfile).filter(items=[
-        'STATE', 'SEX', 'AGE', 'POPEST2019_CIV'
-    ])
-    pop = pop[(pop.STATE == fip_code) & (pop.SEX == 0)]
+    answer['eligible'] = reference.eligible(16, fip_code)
+    for since, age in ELIGIBILITY:
+        answer.loc[answer['date'] > pd.to_datetime(since), 'eligible'] = reference.eligible(age, fip_code)
 
-    #
-    # Convert to total population
-    #
-    pop5  = pop[(pop.AGE >= 5 ) & (pop.AGE < 900)]['POPEST2019_CIV'].sum()
-    pop12 = pop[(pop.AGE >= 12) & (pop.AGE < 900)]['POPEST2019_CIV'].sum()
-    pop16 = pop[(pop.AGE >= 16) & (pop.AGE < 900)]['POPEST2019_CIV'].sum()
+    answer['onedose_pop'] = answer['onedose'] / answer['eligible']
+    answer['complete_pop'] = answer['complete'] / answer['eligible']
 
-    #
-    # Merge
-    #
-    w1 = np.where(answer['date'] > pd.to_datetime(date(2021,5,10)), pop12, pop16)
-    answer['eligible'] = np.where(answer['date'] > pd.to_datetime(date(2021,11,3)), pop5, w1)
+    return answer
 
-    #
-    # Save
-    #
-    rconn.hset("statevac"+key,"dataframe",context.serialize(answer).to_buffer().to_pybytes())
-    rconn.hset("statevac"+key,"expires",str(time.time()+600.0))
 
-    return answer
+#
+# Vaccines were open to those 16 and older, then from these dates, to
+# those of the given age and older
+#
+ELIGIBILITY = [
+    (date(2021,5,10), 12),
+    (date(2021,11,3), 5)
+]
+
+
+@scheduler.source("statevac", 480.0)
+def refreshVaccines(rconn):
+    gather(*[
+        lambda key=key: cache.renew(rconn, "statevac"+key, lambda: downloadVaccine(key), ttl=600.0)
+        for key in fetchPopulation(rconn).state
+    ])
 
 
 
 
 def fetchRecentVaccine(rconn):
-    context = pyarrow.default_serialization_context()
+    return cache.fetch(rconn, "staterecvac", downloadRecentVaccine, ttl=600.0)
 
-    #
-    # See: https://dev.socrata.com/foundry/data.cdc.gov/unsk-b7fc
-    #
 
+def downloadRecentVaccine():
     #
-    # Check date of main dataframe
+    # See: https://dev.socrata.com/foundry/data.cdc.gov/unsk-b7fc
     #
-    expires = rconn.hget("staterecvac","expires")
-    if expires and time.time() < float(expires):
-        return context.deserialize(rconn.hget("staterecvac","dataframe"))
 
     #
     # Fetch, sorted by date, to get most recent results, and fetch enough
@@ -349,21 +353,17 @@ def fetchRecentVaccine(rconn):
         'series_complete_yes'
     ]
 
-    req = requests.get(
+    text = upstream.get(
         "https://data.cdc.gov/resource/unsk-b7fc.csv",
         params={
             '$order': "Date DESC",
             '$limit': 200, 
             '$select': ",".join(columns),
             "$$app_token": app.config['SOCRATA_TOKEN']
-        },
-        headers = {'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:77.0) Gecko/20100101 Firefox/77.0'}
+        }
     )
 
-    if req.status_code != 200:
-        raise Exception("Request failure: {}".format(req.status_code))
-
-    answer = pd.read_csv(StringIO(req.text), parse_dates=["Date"]).rename(columns={
+    answer = pd.read_csv(StringIO(text), parse_dates=["Date"]).rename(columns={
         'Date': 'date',
         'Location': 'key',
         'administered_dose1_recip': 'onedose',
@@ -378,70 +378,35 @@ def fetchRecentVaccine(rconn):
     #
     # Merge with FIPS
     #
-    fipfile = path.join(app.config['DATA_DIR'],"fips-code.csv")
-    fips = pd.read_csv(fipfile,sep="\t")
-    answer = answer.merge(fips,on="key")
+    answer = answer.merge(reference.fips(),on="key")
 
     #
-    # Get population > 12 years old
+    # Get the population currently eligible
     #
-    popfile = path.join(app.config['DATA_DIR'],"sc-est2019-agesex-civ.csv")
-    pop = pd.read_csv(popfile).filter(items=[
-        'STATE', 'SEX', 'AGE', 'POPEST2019_CIV'
-    ])
-    pop = pop[(pop.AGE >= 5) & (pop.AGE < 900) & (pop.SEX == 0)].filter(
-        items=("STATE","POPEST2019_CIV")
-    ).rename(columns={
-        'STATE': 'code',
-        'POPEST2019_CIV': 'eligible'
-    })
-
-    pop = pop.groupby(by="code").sum().reset_index()
+    pop = reference.eligible(ELIGIBILITY[-1][1]).rename("eligible").rename_axis("code").reset_index()
 
     #
     # Merge into answer
     #
     answer = answer.merge(pop,on="code")
 
-    #
-    # Save
-    #
-    rconn.hset("staterecvac","dataframe",context.serialize(answer).to_buffer().to_pybytes())
-    rconn.hset("staterecvac","expires",str(time.time()+600.0))
+    answer['onedose_pop'] = answer['onedose'] / answer['eligible']
+    answer['complete_pop'] = answer['complete'] / answer['eligible']
 
     return answer
 
 
-def fetchPopulation(rconn):
-    context = pyarrow.default_serialization_context()
-    if rconn.hexists("state","population"):
-        return context.deserialize(rconn.hget("state","population"))
+@scheduler.source("staterecvac", 480.0)
+def refreshRecentVaccine(rconn):
+    cache.renew(rconn, "staterecvac", downloadRecentVaccine, ttl=600.0)
 
-    #
-    # Create for first time
-    #
-    popfile = path.join(app.config['DATA_DIR'],"pop-est2019.csv")
-    namefile = path.join(app.config['DATA_DIR'],"state-abbre.csv")
-
-    pop = pd.read_csv(popfile).merge(pd.read_csv(namefile).rename(columns={'State':'NAME'}),on="NAME")
-    pop = pop.filter(items=("NAME","Code","POPESTIMATE2019")).rename(columns={"Code":"state"})
 
-    rconn.hset("state","population",context.serialize(pop).to_buffer().to_pybytes())
-    return pop
+def fetchPopulation(rconn):
+    return reference.state_populations()
 
 
 def fetchPolitics(rconn):
-    context = pyarrow.default_serialization_context()
-    if rconn.hexists("state","politics"):
-        return context.deserialize(rconn.hget("state","politics"))
-        
-    politicsfile = path.join(app.config['DATA_DIR'],"state-party-affiliation.csv")
-    namefile = path.join(app.config['DATA_DIR'],"state-abbre.csv")
-    pol = pd.read_csv(politicsfile, sep="\t")
-    pol = pol.merge(pd.read_csv(namefile).rename(columns={'State':'state'}),on="state")
-
-    rconn.hset("state","politics",context.serialize(pol).to_buffer().to_pybytes())
-    return pol
+    return reference.politics()
 
 
 def menu():
@@ -497,8 +462,6 @@ def plot(code, time):
         )
         return (case_points + case_average).properties(width=500, height=200, title=title)
 
-    dt['croll'] = dt.new_case.rolling(window=7).mean()
-    dt['droll'] = dt.new_death.rolling(window=7).mean()
     chart = alt.Chart(dt.filter(
         items = case_items + ("new_death","droll")
     ))
@@ -528,8 +491,7 @@ def plot(code, time):
 
 def hospitals(code, time):
     r = connect()
-    dt = fetchState(r,code)
-    dth = fetchHospital(r,code)
+    dt, dth = gather(lambda: fetchState(r,code), lambda: fetchHospital(r,code))
     pop = fetchPopulation(r)
 
     if time > 0:
@@ -573,7 +535,6 @@ def hospitals(code, time):
         )
         return (case_points + case_average).properties(width=500, height=200, title=title)
 
-    dt['croll'] = dt.new_case.rolling(window=7).mean()
     chart = alt.Chart(dt.filter(items = case_items))
     top = case_plot(chart)
 
@@ -611,9 +572,6 @@ def vaccines(code, time):
     r = connect()
     dt = fetchVaccine(r,code)
 
-    dt['onedose_pop'] = dt['onedose'] / dt['eligible']
-    dt['complete_pop'] = dt['complete'] / dt['eligible']
-
     if time > 0:
         dt = dt[dt.date > pd.Timestamp.today() - pd.Timedelta(time,unit="d")]
 
@@ -654,11 +612,12 @@ def vaccines_bar():
     r = connect()
     dt = fetchRecentVaccine(r)
 
-    dt['onedose'] = dt['onedose'] / dt['eligible']
-    dt['complete'] = dt['complete'] / dt['eligible']
     reduced = dt.filter(items=[
-        'key', 'onedose', 'complete'
-    ]).sort_values(by="key")
+        'key', 'onedose_pop', 'complete_pop'
+    ]).rename(columns={
+        'onedose_pop': 'onedose',
+        'complete_pop': 'complete'
+    }).sort_values(by="key")
 
     datestamp = pd.to_datetime(dt['date'].values[0]).strftime('%D')
 
@@ -691,12 +650,13 @@ def vaccines_by_party():
     pol = fetchPolitics(r).filter(items=("Code","democrat")).rename(columns={"Code":"key"})
     dt = dt.merge(pol,on="key")
 
-    dt['onedose'] = dt['onedose'] / dt['eligible']
-    dt['complete'] = dt['complete'] / dt['eligible']
     dt['democrat'] = dt['democrat'] / 100.0
     reduced = dt.filter(items=[
-        'key', 'onedose', 'complete', "democrat"
-    ]).sort_values(by="key")
+        'key', 'onedose_pop', 'complete_pop', "democrat"
+    ]).rename(columns={
+        'onedose_pop': 'onedose',
+        'complete_pop': 'complete'
+    }).sort_values(by="key")
 
     datestamp = pd.to_datetime(dt['date'].values[0]).strftime('%D')
 
@@ -746,27 +706,64 @@ def vaccines_by_party():
     return (points + marks).to_dict()
 
 
+#
+# Ranking of states by their latest 7 day average of new cases and
+# fatalities, absolute and per 100,000 population
+#
+# The recent data is sorted once, and the trailing average of every state
+# taken together from its last seven rows (NaN if it has fewer, or any
+# are missing, as with rolling(7)). The answer is kept in the "staterank"
+# hash, tagged with the version of the data it was made from (see
+# cache.version), and shared by every chart that ranks states.
+#
+# The recent data is fetched first, in any case, so that it is refreshed
+# once expired. If its version moved meanwhile, we can't tell which
+# version we were given, so the ranking made from it isn't kept.
+#
+def fetchRanking(rconn):
+    before = cache.version(rconn, ["staterecent"])
+    dt = fetchRecent(rconn)
+    current = cache.version(rconn, ["staterecent"])
+
+    if rconn.hget("staterank", "version") == current.encode():
+        answer = cache.get(rconn, "staterank", expires=None)
+        if answer is not None:
+            return answer
+
+    pop = fetchPopulation(rconn)
+
+    latest = dt.sort_values(["state","dt"]).groupby("state").tail(7)
+    answer = latest.groupby("state")[["new_case","new_death"]].sum(min_count=7)/7
+    answer = answer.reset_index().merge(pop.filter(items=("state","POPESTIMATE2019")), on="state", how="left")
+    answer['cases'] = 100000*answer.new_case/answer.POPESTIMATE2019
+    answer['deaths'] = 100000*answer.new_death/answer.POPESTIMATE2019
+
+    if before == current:
+        cache.put(rconn, "staterank", answer, expires=None)
+        rconn.hset("staterank", "version", current)
+    return answer
+
+
+#
+# The worst five states by the given column of the ranking
+#
+def worstStates(rconn, column):
+    ranking = fetchRanking(rconn).dropna(subset=[column])
+    return ranking.sort_values(column, ascending=False).state[0:5]
+
+
 def top_four_cases(time):
     r = connect()
-    dt = fetchRecent(r)
-    
+
     #
-    # Reduce dataframe to four worst states, by most recent 7 day rolling
+    # Four worst states, by most recent 7 day rolling
     #
-    ranking = dt.loc[:,("dt","state","new_case")].groupby("state").apply(
-        lambda s: s.sort_values("dt").new_case.rolling(window=7).mean().tail(1)
-    )
-    worst = ranking.sort_values(ascending=False).reset_index().state[0:5]
+    worst = worstStates(r, "new_case")
 
     #
     # Fetch those states
     #
-    def fetchWithRoll(code):
-        answer = fetchState(r,code)
-        answer['roll'] = answer.new_case.rolling(window=7).mean()
-        return answer
-
-    dtds = pd.concat([fetchWithRoll(code) for code in worst])
+    dtds = pd.concat(fetchStates(r,worst).values()).rename(columns={"croll":"roll", "crollpc":"rollpc"})
 
     if time > 0:
         dtds = dtds[dtds.dt >= pd.Timestamp.today() - pd.Timedelta(time,unit="d")]
@@ -791,31 +788,16 @@ def top_four_cases(time):
 
 def top_four_cases_capita(time):
     r = connect()
-    dt = fetchRecent(r)
-    pop = fetchPopulation(r)
 
-    dt = dt.merge(pop,on="state")
-    dt['cases'] = 100000*dt.new_case/dt.POPESTIMATE2019
-    
     #
-    # Reduce dataframe to four worst states, by most recent 7 day rolling
+    # Four worst states, by most recent 7 day rolling
     #
-    ranking = dt.loc[:,("dt","state","cases")].groupby("state").apply(
-        lambda s: s.sort_values("dt").cases.rolling(window=7).mean().tail(1)
-    )
-    worst = ranking.sort_values(ascending=False).reset_index().state[0:5]
+    worst = worstStates(r, "cases")
 
     #
     # Fetch those states
     #
-    def fetchWithRoll(code):
-        answer = fetchState(r,code)
-        answer['roll'] = answer.new_case.rolling(window=7).mean()
-        return answer
-
-    dtds = pd.concat([fetchWithRoll(code) for code in worst])
-    dtds = dtds.merge(pop,on="state")
-    dtds['rollpc'] = 100000*dtds.roll/dtds.POPESTIMATE2019
+    dtds = pd.concat(fetchStates(r,worst).values()).rename(columns={"croll":"roll", "crollpc":"rollpc"})
 
     if time > 0:
         dtds = dtds[dtds.dt >= pd.Timestamp.today() - pd.Timedelta(time,unit="d")]
@@ -840,25 +822,16 @@ def top_four_cases_capita(time):
 
 def top_five_fatalities(time):
     r = connect()
-    dt = fetchRecent(r)
-    
+
     #
-    # Reduce dataframe to four worst states, by most recent 7 day rolling
+    # Four worst states, by most recent 7 day rolling
     #
-    ranking = dt.loc[:,("dt","state","new_death")].groupby("state").apply(
-        lambda s: s.sort_values("dt").new_death.rolling(window=7).mean().tail(1)
-    )
-    worst = ranking.sort_values(ascending=False).reset_index().state[0:5]
+    worst = worstStates(r, "new_death")
 
     #
     # Fetch those states
     #
-    def fetchWithRoll(code):
-        answer = fetchState(r,code)
-        answer['roll'] = answer.new_death.rolling(window=7).mean()
-        return answer
-
-    dtds = pd.concat([fetchWithRoll(code) for code in worst])
+    dtds = pd.concat(fetchStates(r,worst).values()).rename(columns={"droll":"roll", "drollpc":"rollpc"})
 
     if time > 0:
         dtds = dtds[dtds.dt >= pd.Timestamp.today() - pd.Timedelta(time,unit="d")]
@@ -883,31 +856,16 @@ def top_five_fatalities(time):
 
 def top_five_fatalities_capita(time):
     r = connect()
-    dt = fetchRecent(r)
-    pop = fetchPopulation(r)
 
-    dt = dt.merge(pop,on="state")
-    dt['deaths'] = 100000*dt.new_death/dt.POPESTIMATE2019
-    
     #
-    # Reduce dataframe to four worst states, by most recent 7 day rolling
+    # Four worst states, by most recent 7 day rolling
     #
-    ranking = dt.loc[:,("dt","state","deaths")].groupby("state").apply(
-        lambda s: s.sort_values("dt").deaths.rolling(window=7).mean().tail(1)
-    )
-    worst = ranking.sort_values(ascending=False).reset_index().state[0:5]
+    worst = worstStates(r, "deaths")
 
     #
     # Fetch those states
     #
-    def fetchWithRoll(code):
-        answer = fetchState(r,code)
-        answer['roll'] = answer.new_death.rolling(window=7).mean()
-        return answer
-
-    dtds = pd.concat([fetchWithRoll(code) for code in worst])
-    dtds = dtds.merge(pop,on="state")
-    dtds['rollpc'] = 100000*dtds.roll/dtds.POPESTIMATE2019
+    dtds = pd.concat(fetchStates(r,worst).values()).rename(columns={"droll":"roll", "drollpc":"rollpc"})
 
     if time > 0:
         dtds = dtds[dtds.dt >= pd.Timestamp.today() - pd.Timedelta(time,unit="d")]
@@ -932,17 +890,8 @@ def top_five_fatalities_capita(time):
 
 def big_four_cases_capita(time):
     r = connect()
-    pop = fetchPopulation(r)
 
-    def fetchWithRoll(code):
-        answer = fetchState(r,code)
-        answer['roll'] = answer.new_case.rolling(window=7).mean()
-        return answer
-
-    dt = pd.concat([fetchWithRoll(code) for code in ["TX","CA","NY","FL"]])
-
-    dt = dt.merge(pop,on="state")
-    dt['rollpc'] = 100000*dt.roll/dt.POPESTIMATE2019
+    dt = pd.concat(fetchStates(r,["TX","CA","NY","FL"]).values()).rename(columns={"croll":"roll", "crollpc":"rollpc"})
 
     if time > 0:
         dt = dt[dt.dt >= pd.Timestamp.today() - pd.Timedelta(time,unit="d")]
@@ -967,12 +916,7 @@ def big_four_cases_capita(time):
 def big_four_cases(time):
     r = connect()
 
-    def fetchWithRoll(code):
-        answer = fetchState(r,code)
-        answer['roll'] = answer.new_case.rolling(window=7).mean()
-        return answer
-
-    dt = pd.concat([fetchWithRoll(code) for code in ["TX","CA","NY","FL"]])
+    dt = pd.concat(fetchStates(r,["TX","CA","NY","FL"]).values()).rename(columns={"croll":"roll", "crollpc":"rollpc"})
 
     if time > 0:
         dt = dt[dt.dt >= pd.Timestamp.today() - pd.Timedelta(time,unit="d")]
@@ -996,17 +940,8 @@ def big_four_cases(time):
 
 def big_four_fatalities(time):
     r = connect()
-    pop = fetchPopulation(r)
 
-    def fetchWithRoll(code):
-        answer = fetchState(r,code)
-        answer['roll'] = answer.new_death.rolling(window=7).mean()
-        return answer
-
-    dt = pd.concat([fetchWithRoll(code) for code in ["TX","CA","NY","FL"]])
-
-    dt = dt.merge(pop,on="state")
-    dt['rollpc'] = 100000*dt.roll/dt.POPESTIMATE2019
+    dt = pd.concat(fetchStates(r,["TX","CA","NY","FL"]).values()).rename(columns={"droll":"roll", "drollpc":"rollpc"})
 
     if time > 0:
         dt = dt[dt.dt >= pd.Timestamp.today() - pd.Timedelta(time,unit="d")]
@@ -1030,14 +965,9 @@ def big_four_fatalities(time):
 
 def death_bar():
     r = connect()
-    dt = fetchRecent(r)
     pop = fetchPopulation(r)
 
-    dt = dt.merge(pop,on="state")
-    dt['deaths'] = 100000*dt.new_death/dt.POPESTIMATE2019
-
-    latest = dt.groupby("state").apply(lambda r: r.sort_values(by="dt").new_death.rolling(7).mean().tail(1))
-    latest = latest.reset_index()
+    latest = fetchRanking(r).filter(items=("state","new_death"))
     latest = latest.merge(pop,on="state")
 
     latest['dper'] = 100000*latest.new_death/latest.POPESTIMATE2019
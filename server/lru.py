@@ -0,0 +1,69 @@
+from collections import OrderedDict
+import time, threading
+
+#
+# A small least-recently-used cache of dataframes, bounded by size in
+# bytes. Each entry also has a time after which it is no longer valid,
+# and a tag (such as a version) that must match when it is read.
+#
+class lru:
+    def __init__(self, capacity, max_age):
+        self.capacity = capacity
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, token, tag=None):
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is None:
+                return None
+
+            frame, nbytes, until, stored = entry
+            if time.time() >= until or stored != tag:
+                self.remove(token)
+                return None
+
+            self.entries.move_to_end(token)
+            return frame
+
+    #
+    # The tag an entry was stored with, or None if there is no such entry
+    #
+    def tag(self, token):
+        with self.lock:
+            entry = self.entries.get(token)
+            return None if entry is None else entry[3]
+
+    def put(self, token, frame, until, tag=None):
+        nbytes = int(frame.memory_usage(index=True, deep=True).sum())
+        if nbytes > self.capacity:
+            return
+
+        with self.lock:
+            if token in self.entries:
+                self.remove(token)
+
+            self.entries[token] = (frame, nbytes, min(until, time.time()+self.max_age), tag)
+            self.size += nbytes
+
+            while self.size > self.capacity:
+                self.remove(next(iter(self.entries)))
+
+    #
+    # Drop every entry belonging to the given redis key
+    #
+    def drop(self, key):
+        with self.lock:
+            for token in [t for t in self.entries if t[0] == key]:
+                self.remove(token)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def remove(self, token):
+        frame, nbytes, until, tag = self.entries.pop(token)
+        self.size -= nbytes
@@ -2,9 +2,22 @@ from flask import Blueprint, render_template
 from .drivers.country import menu as country_menu
 from .drivers.state import menu as state_menu
 from .drivers.county import menu as county_menu
+from .responses import cached
 
 main_page = Blueprint('main_page', __name__)
+
+#
+# The main page only changes with the country names in its menus (state
+# names are reference data, see server/reference.py), so it is rendered
+# once per version of the country data, and kept with the chart responses
+# (see responses.cached). The country and county menus are searched as
+# they are used (see server/search.py).
+#
+def menu_sources(args):
+    return ["country4"]
+
 @main_page.route("/")
+@cached({}, menu_sources, 300, mimetype="text/html")
 def index():
     return render_template(
         "main.html",
@@ -0,0 +1,52 @@
+from os import path, walk
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#
+# Precompress the static files
+#
+# Writes a gzipped copy (.gz), and if the brotli package is installed, a
+# brotli copy (.br), next to each text file under static/. The static
+# routes (see server/__init__.py) send these to clients that accept them.
+# Copies are only rewritten when the original changes.
+#
+# Run after each deploy with:
+#
+#     python3 -m server.precompress
+#
+STATIC_DIR = path.join(path.dirname(__file__), "..", "static")
+EXTENSIONS = (".js", ".css", ".html", ".svg", ".json", ".map", ".txt")
+
+def compressors():
+    answer = {".gz": lambda data: gzip.compress(data, 9)}
+    if brotli:
+        answer[".br"] = lambda data: brotli.compress(data, quality=11)
+    return answer
+
+
+def run(root=STATIC_DIR):
+    for dirpath, dirnames, filenames in walk(root):
+        for name in filenames:
+            if not name.endswith(EXTENSIONS):
+                continue
+
+            source = path.join(dirpath, name)
+            data = None
+            for suffix, compress in compressors().items():
+                target = source + suffix
+                if path.exists(target) and path.getmtime(target) >= path.getmtime(source):
+                    continue
+                if data is None:
+                    with open(source, "rb") as f:
+                        data = f.read()
+                with open(target, "wb") as f:
+                    f.write(compress(data))
+                print(target)
+
+
+if __name__ == "__main__":
+    run()
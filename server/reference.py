@@ -0,0 +1,224 @@
+from flask import current_app as app
+from functools import wraps
+from os import path
+import pandas as pd
+import threading
+
+#
+# Reference data
+#
+# The census and naming tables bundled in DATA_DIR never change while the
+# site runs, so each is parsed once per process, the first time it is
+# needed, and kept in memory along with its lookup indexes.
+#
+# preload() reads them all at once. It is called as the app is created,
+# so when gunicorn is run with --preload (see EC2/README.md), the tables
+# are read once, before the workers fork, and the workers share them.
+#
+# Each table is declared with @table(name), on a function that loads it.
+#
+tables = {}
+loaded = {}
+loaded_lock = threading.RLock()
+
+class table:
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, load):
+        name = self.name
+
+        @wraps(load)
+        def get():
+            with loaded_lock:
+                if name not in loaded:
+                    loaded[name] = load()
+                return loaded[name]
+
+        tables[name] = get
+        return get
+
+
+def preload():
+    for get in tables.values():
+        get()
+
+
+def read(name, **kwargs):
+    return pd.read_csv(path.join(app.config['DATA_DIR'],name), **kwargs)
+
+
+#
+# State names ("State") and postal codes ("Code")
+#
+@table("states")
+def states():
+    return read("state-abbre.csv")
+
+
+#
+# State postal code, by name
+#
+@table("state_codes")
+def state_codes():
+    names = states()
+    return dict(zip(names.State,names.Code))
+
+
+#
+# State FIPS code ("code", a number), by postal code ("key")
+#
+@table("fips")
+def fips():
+    return read("fips-code.csv", sep="\t")
+
+
+@table("fips_codes")
+def fips_codes():
+    codes = fips()
+    return dict(zip(codes.key,codes.code))
+
+
+#
+# 2019 population estimate ("POPESTIMATE2019") of each state, with its
+# name ("NAME") and code ("state")
+#
+@table("state_populations")
+def state_populations():
+    pop = read("pop-est2019.csv").merge(states().rename(columns={'State':'NAME'}),on="NAME")
+    return pop.filter(items=("NAME","Code","POPESTIMATE2019")).rename(columns={"Code":"state"})
+
+
+#
+# Party affiliation by state, from the Gallup poll
+#
+@table("politics")
+def politics():
+    pol = read("state-party-affiliation.csv", sep="\t")
+    return pol.merge(states().rename(columns={'State':'state'}),on="state")
+
+
+#
+# 2019 civilian population of each state (rows, by FIPS code) by year of
+# age (columns, 0 through 85, the last meaning 85 and over), both sexes
+#
+@table("state_ages")
+def state_ages():
+    pop = read("sc-est2019-agesex-civ.csv", usecols=("STATE","SEX","AGE","POPEST2019_CIV"))
+    pop = pop[(pop.SEX == 0) & (pop.AGE < 900)]
+    return pop.pivot(index="STATE", columns="AGE", values="POPEST2019_CIV").fillna(0)
+
+
+#
+# 2019 civilian population of each state (rows, by FIPS code) at or above
+# each age (columns, 0 through 85), for eligibility by age
+#
+@table("state_ages_over")
+def state_ages_over():
+    ages = state_ages()
+    return ages.iloc[:,::-1].cumsum(axis=1).iloc[:,::-1]
+
+
+#
+# The population of the given state (FIPS code), or of every state (a
+# series by FIPS code), aged min_age or older
+#
+def eligible(min_age, fips=None):
+    over = state_ages_over()
+    column = min(max(min_age,0), over.columns.max())
+    return over[column] if fips is None else over.at[fips,column]
+
+
+#
+# 2019 population estimate ("POPESTIMATE2019") of each county ("CTYNAME",
+# in full, e.g. "Harris County"), by state name ("STNAME"), with its FIPS
+# code ("fips", state and county, e.g. 48201)
+#
+@table("county_populations")
+def county_populations():
+    answer = read("co-est2019-alldata.csv", encoding='Windows-1252', usecols=(
+        'SUMLEV','STATE','COUNTY','CTYNAME','STNAME','POPESTIMATE2019'
+    ))
+    answer = answer[answer.SUMLEV == 50]
+    answer = answer.assign(fips=answer.STATE*1000 + answer.COUNTY)
+    return answer.filter(items=['CTYNAME','STNAME','POPESTIMATE2019','fips']).reset_index(drop=True)
+
+
+#
+# County population, by FIPS code
+#
+@table("county_fips")
+def county_fips():
+    all = county_populations()
+    return dict(zip(all.fips,all.POPESTIMATE2019))
+
+
+#
+# County population, by state name and normalized county name (see
+# county_key). Each county is under its full census name ("harris county",
+# "richmond city") and, unless that is ambiguous within its state, its
+# name without the suffix ("harris"), which is how the NYT names most.
+#
+COUNTY_SUFFIXES = (" city and borough", " census area", " municipality", " borough", " parish", " county", " city")
+
+def county_key(name):
+    return " ".join(str(name).lower().split())
+
+def county_base(key):
+    for suffix in COUNTY_SUFFIXES:
+        if key.endswith(suffix):
+            return key[:-len(suffix)]
+    return key
+
+@table("county_index")
+def county_index():
+    all = county_populations()
+    keys = all.CTYNAME.map(county_key)
+
+    answer = dict(zip(zip(all.STNAME,keys),all.POPESTIMATE2019))
+
+    bases = pd.Series(list(zip(all.STNAME,keys.map(county_base))))
+    unique = ~bases.duplicated(keep=False)
+    for base, pop in zip(bases[unique], all.POPESTIMATE2019[unique.to_numpy()]):
+        answer.setdefault(base, pop)
+
+    #
+    # The NYT reports the five boroughs together
+    #
+    answer[("New York","new york city")] = sum(
+        answer[("New York",k+" county")] for k in ("new york","kings","queens","bronx","richmond")
+    )
+
+    return answer
+
+
+#
+# County population by county name (as in county_index), for each state
+#
+@table("county_by_state")
+def county_by_state():
+    answer = {}
+    for (state, county), pop in county_index().items():
+        answer.setdefault(state, {})[county] = pop
+    return answer
+
+
+#
+# The population of a county, by FIPS code if known, or else by name,
+# trying, in turn, the name as given, with " County" added, and (as the
+# NYT sometimes calls a county a city) with " City" swapped for " County"
+#
+def county_population(state, county, fips=None):
+    if fips is not None and pd.notna(fips):
+        answer = county_fips().get(int(fips))
+        if answer is not None:
+            return answer
+
+    lookup = county_index()
+    key = county_key(county)
+    answer = lookup.get((state,key))
+    if answer is None:
+        answer = lookup.get((state,key+" county"))
+    if answer is None and key.endswith(" city"):
+        answer = lookup.get((state,key[:-5]+" county"))
+    return answer
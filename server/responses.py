@@ -0,0 +1,263 @@
+from flask import current_app as app, request, make_response, jsonify
+from werkzeug.exceptions import HTTPException
+from urllib.parse import urlencode
+from functools import wraps
+from . import cache, specs
+from .connections import redis_client
+import gzip, hashlib, json, time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#
+# Cache of rendered responses
+#
+# Building a chart is much more work than looking up its data, and the
+# result doesn't change until the data does. We keep the final response
+# body, compressed, in redis, keyed by route and the parameters it uses
+# (with their defaults filled in), and tagged with the version of the
+# cache entries it was built from (see cache.version). A response is also
+# out of date once any of those entries expires, so that the next request
+# renders it again, which refreshes the data.
+#
+# Bodies are compressed once, when rendered, with gzip, and also with
+# brotli if the brotli package is installed. Clients that accept neither
+# get the body decompressed.
+#
+# params: dictionary of request parameters used by the route, and their defaults
+# sources: function of those parameters, returning the redis keys of the data used
+# max_age: how long browsers and proxies may reuse the response, in seconds
+# mimetype: of the response; only json charts are split into parts (below)
+#
+# Responses are kept no longer than RESPONSE_TTL seconds (default one day).
+#
+# Any route also takes the parameter maxpoints, which thins long daily
+# series down to about that many points each (see specs.downsample). It
+# is rounded up to one of MAXPOINTS, so that clients of about the same
+# width share a response.
+#
+# Each chart is stored whole (field "body"), and also split into a template
+# and its datasets, in each of two forms (see specs.split and specs.encode):
+# rows of json (fields "template:json", "json:0", "json:1", ...), and
+# columns (fields "template:columns", "columns:0", ...). Ask for the
+# template with the parameter data=url (rows) or data=columns. Its datasets
+# are then fetched from /api/data. The template holds values drawn from the
+# data (scale domains, dated titles), so it gets the same max_age as the
+# data, and its dataset urls carry the version of the data (parameter v),
+# so a template is never drawn with data from another version: a dataset
+# asked for with any version but the current one is answered with a 404,
+# and the client fetches the template again.
+#
+# Every part carries a strong ETag, a hash of its content, so clients (and
+# nginx) can revalidate with If-None-Match, and get a 304 without us even
+# reading the body.
+#
+def cached(params, sources, max_age, mimetype="application/json"):
+    def decorate(view):
+        def serve(path, part):
+            args = arguments(params, request.args)
+            token = response_token(path, args)
+
+            lifetime = max_age
+
+            rconn = redis_client()
+            current = cache.version(rconn, sources(args))
+            if dataset(part) and request.args.get('v') != current:
+                return jsonify({'status':'failure'}), 404
+
+            encoding = negotiate()
+
+            stamp, stored, expires, tag = rconn.hmget(token, ["version", "encodings", "expires", "tag:"+part])
+            tag = tag and tag.decode()
+
+            if stamp is None or stamp.decode() != current or stored != ENCODINGS.encode() or expired(expires):
+                until = cache.expiry(rconn, sources(args))
+                response = make_response(view())
+                if response.status_code != 200:
+                    return response
+
+                if mimetype == "application/json":
+                    parts = split(response.get_data(), path, args, current)
+                else:
+                    parts = {"body": response.get_data()}
+
+                mapping = {"version": current, "encodings": ENCODINGS, "expires": str(until)}
+                for k,v in parts.items():
+                    mapping[k] = gzip.compress(v)
+                    mapping["tag:"+k] = hashlib.sha1(v).hexdigest()
+                    if brotli:
+                        mapping["br:"+k] = brotli.compress(v)
+
+                #
+                # If the data changed while rendering (we may have drawn a
+                # stale copy while it was refreshed), what we have can't be
+                # said to be of either version, so send it once, but don't
+                # keep it, nor let anyone else
+                #
+                if cache.version(rconn, sources(args)) == current:
+                    pipe = rconn.pipeline()
+                    pipe.delete(token)
+                    pipe.hset(token, mapping=mapping)
+                    pipe.expire(token, int(app.config.get('RESPONSE_TTL',86400)))
+                    pipe.execute()
+                else:
+                    lifetime = 0
+
+                body, tag = mapping.get(field(part,encoding)), mapping.get("tag:"+part)
+            elif tag is not None and entity_tag(tag,encoding) in request.if_none_match:
+                response = make_response("", 304)
+                return headers(response, entity_tag(tag,encoding), max_age)
+            else:
+                body = rconn.hget(token, field(part,encoding))
+
+            if body is None or tag is None:
+                return jsonify({'status':'failure'}), 404
+
+            if entity_tag(tag,encoding) in request.if_none_match:
+                return headers(make_response("", 304), entity_tag(tag,encoding), lifetime)
+
+            return headers(respond(body,encoding,mimetype), entity_tag(tag,encoding), lifetime)
+
+        @wraps(view)
+        def wrapper():
+            if mimetype != "application/json":
+                return serve(request.path, "body")
+            return serve(*target(request.path, request.args))
+
+        wrapper.serve = serve
+        wrapper.settings = (params, sources, max_age)
+        return wrapper
+    return decorate
+
+
+#
+# The request parameters a route uses, with defaults filled in
+#
+def arguments(params, query):
+    args = {k: query.get(k,v) for k,v in params.items()}
+    maxpoints = query.get('maxpoints', type=int)
+    if maxpoints:
+        args['maxpoints'] = str(next((m for m in MAXPOINTS if m >= maxpoints), MAXPOINTS[-1]))
+    return args
+
+
+MAXPOINTS = (250, 500, 1000)
+
+
+def expired(expires):
+    return expires is not None and time.time() >= float(expires)
+
+
+def response_token(path, args):
+    return "response:{}?{}".format(path, urlencode(sorted(args.items())))
+
+
+#
+# The chart path and part asked for by a request, for either a chart
+# route, or /api/data (None if not a part we keep)
+#
+def target(path, query):
+    if path.startswith("/api/data/"):
+        form = query.get('format','json')
+        if form not in FORMS.values():
+            return None
+        return "/api/" + path[len("/api/data/"):], form + ":" + query.get('set','0')
+
+    form = FORMS.get(query.get('data'))
+    return path, "template:"+form if form else "body"
+
+
+def dataset(part):
+    return part != "body" and not part.startswith("template:")
+
+
+#
+# Forms of chart data, by the value of the "data" request parameter
+#
+FORMS = {'url': "json", 'columns': "columns"}
+
+
+#
+# The rendered chart, whole and in parts
+#
+def split(body, path, args, version):
+    spec = json.loads(body)
+    if not isinstance(spec, dict):
+        return {"body": body}
+
+    if 'maxpoints' in args:
+        specs.downsample(spec, int(args['maxpoints']))
+        body = json.dumps(spec).encode()
+
+    chart = path[len("/api/"):]
+    query = urlencode(sorted(args.items()))
+
+    answer = {"body": body}
+    for form in FORMS.values():
+        template, datasets = specs.split(
+            json.loads(body),
+            lambda i: "/api/data/{}?{}&v={}&set={}&format={}".format(chart, query, version, i, form),
+            form
+        )
+        answer["template:"+form] = json.dumps(template).encode()
+        for i,rows in enumerate(datasets):
+            answer["{}:{}".format(form,i)] = specs.encode(rows, form)
+
+    return answer
+
+
+#
+# The cached chart view behind the given path, if any
+#
+def lookup(path, attribute="serve"):
+    try:
+        endpoint, _ = app.url_map.bind("").match(path)
+    except HTTPException:
+        return None
+    return getattr(app.view_functions.get(endpoint), attribute, None)
+
+
+#
+# The encodings we store, and the best of them the client accepts (None
+# if neither)
+#
+ENCODINGS = "br,gzip" if brotli else "gzip"
+
+def negotiate(accept=None):
+    accept = request.accept_encodings if accept is None else accept
+    return accept.best_match(ENCODINGS.split(","))
+
+
+def field(part, encoding):
+    return "br:"+part if encoding == "br" else part
+
+
+#
+# Each encoding is a different representation, so gets its own tag
+#
+def entity_tag(tag, encoding):
+    return tag + {"gzip": "-gz", "br": "-br"}.get(encoding, "")
+
+
+#
+# Send a compressed body, as is if the client accepts it
+#
+def respond(body, encoding, mimetype="application/json"):
+    if encoding:
+        response = make_response(body)
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = make_response(gzip.decompress(body))
+
+    response.mimetype = mimetype
+    return response
+
+
+def headers(response, etag, max_age):
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.vary.add('Accept-Encoding')
+    return response
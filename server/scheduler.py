@@ -0,0 +1,93 @@
+from flask import current_app as app
+import time, random, json
+
+#
+# Background refresh of the cached data sources
+#
+# Each driver registers the sources it downloads, along with how often
+# they should be refreshed. The scheduler runs as its own process, and
+# refreshes every source a little before its cache entry expires, so
+# requests to the web server never have to wait on a download.
+#
+# Run with:
+#
+#     python3 -m server.scheduler
+#
+# The time and duration of the last refresh of each source are kept in
+# the redis hash "schedule", and reported by /api/status.
+#
+sources = {}
+
+class source:
+    def __init__(self, name, interval):
+        self.name = name
+        self.interval = interval
+
+    #
+    # Used as a decorator on the refresh function, which takes a redis connection
+    #
+    def __call__(self, refresh):
+        self.refresh = refresh
+        sources[self.name] = self
+        return refresh
+
+    #
+    # Intervals can be overridden in config.py, using SCHEDULE, a dictionary
+    # of intervals keyed by source name. Add a little jitter, so that sources
+    # with similar intervals don't all refresh at once.
+    #
+    def delay(self):
+        interval = app.config.get('SCHEDULE',{}).get(self.name,self.interval)
+        jitter = app.config.get('SCHEDULE_JITTER',0.1)
+        return interval*(1 + random.uniform(-jitter,jitter))
+
+
+def status(rconn):
+    return {
+        k.decode(): json.loads(v) for k,v in rconn.hgetall("schedule").items()
+    }
+
+
+def run(rconn):
+    #
+    # Pick up where we left off, if we've run before
+    #
+    last = status(rconn)
+    due = {
+        name: last[name]['last'] + s.delay() if name in last else time.time()
+        for name,s in sources.items()
+    }
+
+    while True:
+        name = min(due, key=due.get)
+        wait = due[name] - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+        start = time.time()
+        try:
+            sources[name].refresh(rconn)
+            error = None
+        except Exception as e:
+            app.logger.exception("Refresh of {} failed".format(name))
+            error = str(e)
+
+        finish = time.time()
+        rconn.hset("schedule", name, json.dumps({
+            'last': finish,
+            'duration': finish - start,
+            'error': error
+        }))
+
+        due[name] = finish + sources[name].delay()
+
+
+if __name__ == "__main__":
+    #
+    # Import through the package, so the drivers register their
+    # sources with the same module we run
+    #
+    from server import app as application, scheduler
+    from server.connections import redis_client
+    with application.app_context():
+        scheduler.run(redis_client())
@@ -0,0 +1,103 @@
+from bisect import bisect_left
+from . import cache
+import re, threading
+
+#
+# Typeahead search over the long menus (counties and countries), so that
+# the page doesn't need to carry every choice
+#
+# Each list of choices (values, and the labels shown for them) is indexed
+# in memory, by the prefixes of the words in each label, and by the
+# trigrams of the whole label. A query of three or more characters matches
+# a choice if it appears anywhere in its label (or value); a shorter one,
+# if it starts one of its words. Choices whose label starts with the
+# query come first, then those with a word that does, then the rest, each
+# in alphabetical order.
+#
+# Results are in the form select2 expects from remote data:
+#
+#     {"results": [{"id": ..., "text": ...}], "pagination": {"more": ...}}
+#
+class typeahead:
+    def __init__(self, values, labels):
+        self.values = list(values)
+        self.labels = list(labels)
+        self.text = [
+            label.lower() if value == label else "{} {}".format(label,value).lower()
+            for value,label in zip(self.values,self.labels)
+        ]
+        self.order = sorted(range(len(self.labels)), key=lambda i: self.labels[i].lower())
+
+        self.words = sorted(
+            (word, i) for i,text in enumerate(self.text) for word in set(WORD.findall(text))
+        )
+
+        self.trigrams = {}
+        for i,text in enumerate(self.text):
+            for t in set(text[j:j+3] for j in range(len(text)-2)):
+                self.trigrams.setdefault(t, set()).add(i)
+
+    def find(self, query, page=1, size=50):
+        query = query.strip().lower()
+        if query:
+            found = sorted(self.candidates(query), key=lambda i: (self.rank(i,query), self.labels[i].lower()))
+        else:
+            found = self.order
+
+        start = (max(page,1)-1)*size
+        return {
+            "results": [{"id": self.values[i], "text": self.labels[i]} for i in found[start:start+size]],
+            "pagination": {"more": start+size < len(found)}
+        }
+
+    #
+    # Every choice containing the query
+    #
+    def candidates(self, query):
+        if len(query) < 3:
+            answer = set()
+            for word in WORD.findall(query)[:1]:
+                j = bisect_left(self.words, (word,))
+                while j < len(self.words) and self.words[j][0].startswith(word):
+                    answer.add(self.words[j][1])
+                    j += 1
+            return [i for i in answer if query in self.text[i]]
+
+        answer = None
+        for t in set(query[j:j+3] for j in range(len(query)-2)):
+            answer = self.trigrams.get(t, set()) if answer is None else answer & self.trigrams.get(t, set())
+            if not answer:
+                return []
+        return [i for i in answer if query in self.text[i]]
+
+    def rank(self, i, query):
+        if self.values[i].lower() == query or self.labels[i].lower() == query:
+            return 0
+        if self.text[i].startswith(query):
+            return 1
+        if any(w.startswith(query) for w in self.text[i].split()):
+            return 2
+        return 3
+
+
+WORD = re.compile(r"\w+")
+
+
+#
+# The typeahead index of the given redis key, built (by the given function,
+# returning values and labels) once per version of its data, per worker
+#
+indexes = {}
+indexes_lock = threading.Lock()
+
+def index(rconn, key, build):
+    current = cache.version(rconn, [key])
+    with indexes_lock:
+        found = indexes.get(key)
+    if found is not None and found[0] == current:
+        return found[1]
+
+    answer = typeahead(*build())
+    with indexes_lock:
+        indexes[key] = (current, answer)
+    return answer
@@ -0,0 +1,216 @@
+from datetime import date
+import numpy as np
+import json, re
+
+#
+# Split a Vega-Lite spec into a template and its datasets
+#
+# Altair puts every dataframe a chart uses into the top level "datasets"
+# of the spec, and refers to them by name. We replace each reference with
+# a url, built by the given function from the dataset's index, so the
+# template holds only the layout of the chart, and the data travels
+# separately.
+#
+# Along the way, columns the chart never refers to are dropped. Nothing
+# else is taken out of the data, since the template (with its scale
+# domains, titles, and so on) is itself drawn from a particular version
+# of the data, and must not outlive it (see responses.cached).
+#
+# form: how the datasets will be sent, "json" (rows) or "columns" (see encode)
+#
+def split(spec, url, form="json"):
+    datasets = spec.pop('datasets', {})
+    index = {name: i for i,name in enumerate(datasets)}
+
+    used = None if contains(spec, "transform") else fields(spec)
+
+    answer = [trim(rows, used) for rows in datasets.values()]
+
+    def replace(node):
+        if isinstance(node, dict):
+            data = node.get("data")
+            if isinstance(data, dict) and data.get("name") in index:
+                i = index[data["name"]]
+                node["data"] = {"url": url(i), "format": {"type": form}}
+            for v in node.values():
+                replace(v)
+        elif isinstance(node, list):
+            for v in node:
+                replace(v)
+
+    replace(spec)
+    return spec, answer
+
+
+#
+# Every field the spec refers to, by name
+#
+def fields(node):
+    answer = set()
+    if isinstance(node, dict):
+        for k,v in node.items():
+            if k == "field" and isinstance(v, str):
+                answer.add(v)
+            elif k in ("fields","groupby") and isinstance(v, list):
+                answer.update(f for f in v if isinstance(f, str))
+            else:
+                answer |= fields(v)
+    elif isinstance(node, list):
+        for v in node:
+            answer |= fields(v)
+    return answer
+
+
+def contains(node, key):
+    if isinstance(node, dict):
+        return key in node or any(contains(v, key) for v in node.values())
+    if isinstance(node, list):
+        return any(contains(v, key) for v in node)
+    return False
+
+
+def trim(rows, used):
+    if used is None:
+        return rows
+    return [{k:v for k,v in row.items() if k in used} for row in rows]
+
+
+#
+# Encode a dataset, in the given form
+#
+# The "columns" form is column-oriented, which avoids repeating every key
+# in every row:
+#
+#     {"length": 3, "columns": {
+#         "dt": {"type": "day", "values": [18322, 18323, 18324]},
+#         "cases": {"type": "number", "values": [1.5, 2.25, null]},
+#         "County": {"type": "category", "labels": ["Harris"], "codes": [0, 0, 0]}
+#     }}
+#
+# Dates (which Altair sends as ISO strings at midnight) become days since
+# 1970-01-01, floating point values are cut to single precision, and
+# strings are replaced by indices into a list of distinct labels. It is
+# read by the "columns" format in static/js/custom-vega-embed.js.
+#
+def encode(rows, form):
+    if form == "columns":
+        keys = list(dict.fromkeys(k for row in rows for k in row))
+        rows = {
+            "length": len(rows),
+            "columns": {k: column([row.get(k) for row in rows]) for k in keys}
+        }
+    return json.dumps(rows, separators=(',',':')).encode()
+
+
+MIDNIGHT = re.compile(r"^\d{4}-\d{2}-\d{2}T00:00:00$")
+EPOCH = date(1970,1,1).toordinal()
+
+def column(values):
+    present = [v for v in values if v is not None]
+
+    if present and all(isinstance(v, str) and MIDNIGHT.match(v) for v in present):
+        return {"type": "day", "values": [
+            None if v is None else date.fromisoformat(v[:10]).toordinal() - EPOCH for v in values
+        ]}
+
+    if all(isinstance(v, str) for v in present):
+        labels = list(dict.fromkeys(present))
+        codes = {v:i for i,v in enumerate(labels)}
+        return {"type": "category", "labels": labels, "codes": [
+            None if v is None else codes[v] for v in values
+        ]}
+
+    if all(isinstance(v, (int,float)) and not isinstance(v, bool) for v in present):
+        return {"type": "number", "values": [
+            float("%.7g" % v) if isinstance(v, float) else v for v in values
+        ]}
+
+    return {"type": "value", "values": values}
+
+
+#
+# Thin out long daily series, keeping at most about maxpoints per series
+#
+# In each dataset with a date column, rows are grouped by the string
+# columns (e.g. County), and Largest-Triangle-Three-Buckets is applied to
+# each numeric column of each group that the chart plots. A row is kept
+# if any of its series needs it. Values are not changed, so rolling averages, computed before
+# this, stay exact.
+#
+def downsample(spec, maxpoints):
+    datasets = spec.get('datasets', {})
+    used = None if contains(spec, "transform") else fields(spec)
+    for name, rows in datasets.items():
+        datasets[name] = thin(rows, maxpoints, used)
+
+
+def thin(rows, maxpoints, used=None):
+    if len(rows) <= maxpoints:
+        return rows
+
+    keys = list(dict.fromkeys(k for row in rows for k in row))
+    columns = {k: column([row.get(k) for row in rows]) for k in keys}
+
+    days = [c for c in columns.values() if c["type"] == "day"]
+    if not days:
+        return rows
+
+    x = np.array(days[0]["values"], dtype=float)
+    series = [
+        np.array(c["values"], dtype=float) for k,c in columns.items()
+        if c["type"] == "number" and (used is None or k in used)
+    ]
+    codes = [
+        [-1 if v is None else v for v in c["codes"]]
+        for c in columns.values() if c["type"] == "category"
+    ]
+    groups = np.unique(np.array(codes).T, axis=0, return_inverse=True)[1].ravel() if codes \
+        else np.zeros(len(rows), dtype=int)
+
+    keep = np.zeros(len(rows), dtype=bool)
+    for g in np.unique(groups):
+        members = np.flatnonzero((groups == g) & ~np.isnan(x))
+        members = members[np.argsort(x[members], kind="stable")]
+        for y in series:
+            valid = members[~np.isnan(y[members])]
+            keep[valid[lttb(x[valid], y[valid], maxpoints)]] = True
+
+    return [row for row,k in zip(rows,keep) if k]
+
+
+#
+# Largest-Triangle-Three-Buckets (Steinarsson, 2013)
+#
+# Returns the indices of the (at most) n points chosen from the series x, y
+# (x sorted). The first and last points are always kept. Each bucket in
+# between contributes the point that makes the largest triangle with the
+# point chosen from the previous bucket and the average of the next.
+#
+def lttb(x, y, n):
+    size = len(x)
+    if size <= n or n < 3:
+        return np.arange(size)
+
+    edges = np.floor(np.linspace(1, size-1, n-1)).astype(int)
+    starts, ends = edges[:-1], edges[1:]
+
+    #
+    # Averages of every bucket, plus the last point as the final "next bucket"
+    #
+    cx = np.cumsum(np.concatenate([[0], x]))
+    cy = np.cumsum(np.concatenate([[0], y]))
+    count = ends - starts
+    avg_x = np.append((cx[ends] - cx[starts])/count, x[-1])
+    avg_y = np.append((cy[ends] - cy[starts])/count, y[-1])
+
+    answer = np.empty(n, dtype=int)
+    answer[0], answer[-1] = 0, size-1
+
+    a = 0
+    for i in range(len(starts)):
+        bx, by = x[starts[i]:ends[i]], y[starts[i]:ends[i]]
+        area = np.abs((x[a] - avg_x[i+1])*(by - y[a]) - (x[a] - bx)*(avg_y[i+1] - y[a]))
+        a = starts[i] + int(np.argmax(area))
+        answer[i+1] = a
+
+    return answer
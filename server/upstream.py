@@ -0,0 +1,67 @@
+from flask import current_app as app
+from .connections import redis_client, http_session, host_limit
+import requests, hashlib, json
+
+#
+# Shared client for fetching upstream data
+#
+# We remember the validators (ETag and Last-Modified) sent with each
+# response, and make the next request for the same url conditional. If
+# upstream hasn't changed, NotModified is raised, and the cache simply
+# extends the life of what it already has (see cache.rebuild).
+#
+# Validators are kept in redis for VALIDATOR_TTL seconds (default one week).
+#
+USER_AGENT = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:77.0) Gecko/20100101 Firefox/77.0'
+
+class NotModified(Exception):
+    def __init__(self, url):
+        super().__init__("Not modified: {}".format(url))
+        self.url = url
+
+
+def validator_key(url):
+    return "validators:" + hashlib.sha1(url.encode()).hexdigest()
+
+
+def get(url, params=None):
+    rconn = redis_client()
+    full_url = requests.Request('GET', url, params=params).prepare().url
+
+    headers = {'User-Agent': USER_AGENT}
+    saved = rconn.get(validator_key(full_url))
+    if saved:
+        saved = json.loads(saved)
+        if saved.get('etag'):
+            headers['If-None-Match'] = saved['etag']
+        if saved.get('modified'):
+            headers['If-Modified-Since'] = saved['modified']
+
+    with host_limit(full_url):
+        req = http_session().get(full_url, headers=headers, timeout=app.config.get('HTTP_TIMEOUT',300))
+
+    if req.status_code == 304:
+        raise NotModified(full_url)
+
+    if req.status_code != 200:
+        raise Exception("Request failure: {}".format(req.status_code))
+
+    validators = {
+        'etag': req.headers.get('ETag'),
+        'modified': req.headers.get('Last-Modified')
+    }
+    if validators['etag'] or validators['modified']:
+        rconn.set(
+            validator_key(full_url),
+            json.dumps(validators),
+            ex = int(app.config.get('VALIDATOR_TTL',7*86400))
+        )
+
+    return req.text
+
+
+#
+# Make the next request for this url unconditional
+#
+def forget(url):
+    redis_client().delete(validator_key(url))
@@ -1,3 +1,29 @@
+//
+// Reader for datasets sent by /api/data in the "columns" format
+// (see server/specs.py). Days since 1970-01-01 are returned as dates at
+// local midnight, to match how vega parses ISO dates without a time zone.
+//
+vega.formats('columns', function(data) {
+    const table = (typeof data === 'string') ? JSON.parse(data) : data;
+    const rows = Array.from({length: table.length}, function(){ return {}; });
+
+    function fromDay(day) {
+        const utc = new Date(day*86400000);
+        return new Date(utc.getUTCFullYear(), utc.getUTCMonth(), utc.getUTCDate());
+    }
+
+    for (const [name, column] of Object.entries(table.columns)) {
+        var values = column.values;
+        if (column.type === 'day') {
+            values = values.map(function(d){ return d === null ? null : fromDay(d); });
+        } else if (column.type === 'category') {
+            values = column.codes.map(function(c){ return c === null ? null : column.labels[c]; });
+        }
+        values.forEach(function(v,i){ rows[i][name] = v; });
+    }
+    return rows;
+});
+
 function customVegaEmbed( target, url, opts ) {
     function viewSource(source) {
         const header = `<html><head></head><body><pre><code class="json">`;
@@ -90,13 +116,42 @@ function customVegaEmbed( target, url, opts ) {
         editorLink.addEventListener('click', function (e) {
             post('https://vega.github.io/editor/', {
                 mode: 'vega-lite',
-                spec: JSON.stringify(data,null,2),
+                spec: JSON.stringify(data,editorData,2),
             });
             e.preventDefault();
         });
         ctrl.append(editorLink);
     }
 
+    //
+    // Dataset urls are relative to our server, which the editor is not,
+    // and the editor only knows the standard formats
+    //
+    function editorData(key, value) {
+        if (key === 'url' && typeof value === 'string') {
+            return new URL(value.replace('format=columns','format=json'), window.location.href).href;
+        }
+        if (key === 'format' && value && value.type === 'columns') {
+            return {type: 'json'};
+        }
+        return value;
+    }
+
+    //
+    // A dataset is refused (with a 404) once the data has changed since
+    // the chart was drawn (see server/responses.py). We then fetch the
+    // chart again, once, bypassing the browser cache.
+    //
+    var stale = false;
+    const loader = vega.loader();
+    const http = loader.http;
+    loader.http = function(uri, options) {
+        return http.call(loader, uri, options).catch(function(error){
+            stale = true;
+            throw error;
+        });
+    };
+
     var workspace = $("<div>").addClass(["vega-embed","has-actions"]);
 
     return new Promise(function(resolve,reject){
@@ -106,7 +161,8 @@ function customVegaEmbed( target, url, opts ) {
 
         $.ajax({
             url: url,
-            dataType: 'json'
+            dataType: 'json',
+            headers: opts.retry ? {'Cache-Control': 'no-cache'} : {}
         }).done(function(data){
             try {
                 test_abort();
@@ -114,10 +170,16 @@ function customVegaEmbed( target, url, opts ) {
                 test_abort();
                 view = new vega.View(vega.parse(spec),{
                     renderer: 'svg',
+                    loader: loader,
                     container: workspace.get(0)
                 });
                 test_abort();
                 view.runAsync().then(function(){
+                    if (stale && !opts.retry) {
+                        view.finalize();
+                        resolve(customVegaEmbed(target, url, Object.assign({}, opts, {retry: true})));
+                        return;
+                    }
                     addActions(view,workspace,data,spec);
                     if (opts.maxwidth) {
                         $(workspace).children('svg').each(function(){
@@ -7,9 +7,16 @@ function showPlot(sel,url) {
         imageColor: "grey",
         zIndex: 2
     });
-    customVegaEmbed(sel, url, {
+    //
+    // Fetch the chart as a template, with its data sent separately, by column,
+    // and no more points in a series than there is room for (rounded up, as
+    // the server does, see MAXPOINTS in server/responses.py)
+    //
+    const maxwidth = Math.min($(window).width()-60,640);
+    const maxpoints = [250,500,1000].find(function(m){return m >= maxwidth;}) || 1000;
+    customVegaEmbed(sel, url + "&data=columns&maxpoints=" + maxpoints, {
         abort: function(){return sequence != this_sequence;},
-        maxwidth: Math.min($(window).width()-60,640)
+        maxwidth: maxwidth
     }).then(function(){
         $(sel).LoadingOverlay("hide", true);
     }).catch(console.error);
@@ -100,7 +107,7 @@ function defaults(params) {
                 if (parts[0] == "id") {
                     view_id = value;
                 } else {
-                    $("#"+parts[0]).val(value);
+                    choose($("#"+parts[0]), value);
                 }
             });
         } catch(e) {
@@ -109,12 +116,46 @@ function defaults(params) {
     }
     return view_id;
 }
+//
+// Menus searched on the server hold only the current choice, so add
+// any other, with its label looked up
+//
+function choose(el, value) {
+    const search = el.data("search");
+    if (search && el.find("option").filter(function(){return this.value == value;}).length == 0) {
+        el.append(new Option(value, value));
+        $.getJSON(search, {q: value}, function(data){
+            data.results.forEach(function(r){
+                if (r.id == value) {
+                    el.find("option").filter(function(){return this.value == value;}).text(r.text);
+                    el.trigger("change.select2");
+                }
+            });
+        });
+    }
+    el.val(value);
+}
+function remote(el) {
+    return {
+        width: '18em',
+        ajax: {
+            url: el.data("search"),
+            dataType: 'json',
+            delay: 150,
+            cache: true,
+            data: function(p){return {q: p.term || "", page: p.page || 1};}
+        }
+    };
+}
 $(function(){
     let view_id = defaults(this.location.search.substr(1));
 
-    $("#selcountry,#modecompcountry,#selstate,#modecompstate,#selcounty,#modecompcounty,#selcounty1,#selcounty2").select2({
+    $("#modecompcountry,#selstate,#modecompstate,#modecompcounty").select2({
         width: '18em'
     });
+    $("#selcountry,#selcounty,#selcounty1,#selcounty2").each(function(){
+        $(this).select2(remote($(this)));
+    });
     $("#timecountry,#timecompcountry,#modestate,#timestate,#timecompstate,#timecounty,#timecompcounty,#timecomparecounty").select2({
         width: '10em'
     });